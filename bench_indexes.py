@@ -0,0 +1,108 @@
+# Lookup latency for the role/case tables before and after the index migration.
+#
+#   python bench_indexes.py                       # 10k, 100k and 1M rows
+#   python bench_indexes.py --sizes 10000 --json bench_output.txt
+#
+# Each size builds a throwaway database at schema version 2 (no lookup
+# indexes), times the lookups the app runs, applies the remaining migrations
+# and times them again.
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from zri_db import Database
+
+LOOKUPS = {
+    "cases_for_user": ("SELECT CaseID FROM Witness WHERE UserID = ?", "user"),
+    "participants_for_case": ('''SELECT UserID FROM Witness WHERE CaseID = ?
+                                 UNION ALL SELECT UserID FROM Suspect WHERE CaseID = ?
+                                 UNION ALL SELECT UserID FROM LawEnforcer WHERE CaseID = ?''', "case"),
+    "login": ('''SELECT u.UserID, u.Password, r.RoleName
+                 FROM User u LEFT JOIN Role r ON r.RoleID = u.RoleID
+                 WHERE u.Email = ?''', "login"),
+}
+
+class UnindexedDatabase(Database):
+    # The schema as it was before the lookup indexes existed. Stopping at
+    # version 2 leaves the index migration (and everything after it) pending
+    # for the Database opened afterwards.
+    def migrate(self, target=None):
+        super().migrate(2)
+
+def populate(db_file, rows):
+    # rows users, one Witness/Suspect/LawEnforcer row each, ten participants per case
+    conn = sqlite3.connect(db_file)
+    conn.execute("PRAGMA synchronous = OFF")
+    cases = max(rows // 10, 1)
+    conn.executemany("INSERT INTO Role (RoleName) VALUES (?)",
+                     [("Admin",), ("Witness",), ("Suspect",), ("Law Enforcer",)])
+    conn.executemany("INSERT INTO Cases (CaseID, CaseDescription) VALUES (?, ?)",
+                     ((i, f"Case {i}") for i in range(1, cases + 1)))
+    conn.executemany("INSERT INTO User (UserID, FirstName, LastName, Email, Password, RoleID) VALUES (?, ?, ?, ?, ?, ?)",
+                     ((i, f"First{i}", f"Last{i}", f"user{i}@example.com", f"pw{i}", 2) for i in range(1, rows + 1)))
+    rng = random.Random(0)
+    for table in ("Witness", "Suspect", "LawEnforcer"):
+        conn.executemany(f"INSERT INTO {table} (UserID, CaseID, Gender) VALUES (?, ?, ?)",
+                         ((i, rng.randint(1, cases), "Female") for i in range(1, rows + 1)))
+    conn.commit()
+    conn.close()
+    return cases
+
+def time_lookups(db, rows, cases, lookups):
+    rng = random.Random(1)
+    results = {}
+    for name, (sql, kind) in LOOKUPS.items():
+        samples = []
+        for _ in range(lookups):
+            if kind == "user":
+                params = (rng.randint(1, rows),)
+            elif kind == "case":
+                params = (rng.randint(1, cases),) * 3
+            else:
+                params = (f"user{rng.randint(1, rows)}@example.com",)
+            start = time.perf_counter()
+            db.cur.execute(sql, params).fetchall()
+            samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        results[name] = {
+            "p50_ms": statistics.median(samples),
+            "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+            "plan": " / ".join(row[3] for row in db.cur.execute("EXPLAIN QUERY PLAN " + sql, params)),
+        }
+    return results
+
+def run(sizes, lookups):
+    report = []
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, "bench.db")
+            db = UnindexedDatabase(db_file)
+            cases = populate(db_file, rows)
+            before = time_lookups(db, rows, cases, lookups)
+            db.close_connection()
+
+            db = Database(db_file)
+            after = time_lookups(db, rows, cases, lookups)
+            db.close_connection()
+        for name in LOOKUPS:
+            report.append({"rows": rows, "lookup": name, "before": before[name], "after": after[name]})
+            print(f"{rows:>9} {name:<22} before p50 {before[name]['p50_ms']:9.3f} ms  p99 {before[name]['p99_ms']:9.3f} ms"
+                  f"  |  after p50 {after[name]['p50_ms']:7.3f} ms  p99 {after[name]['p99_ms']:7.3f} ms")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark role/case lookups with and without indexes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--lookups", type=int, default=100, help="random lookups timed per query")
+    parser.add_argument("--json", help="also write the results to this file as JSON")
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.lookups)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
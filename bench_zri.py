@@ -0,0 +1,382 @@
+# Offline benchmark suite for the scoring and database hot paths.
+#
+#   python bench_zri.py                          # small scale, stand-in models
+#   python bench_zri.py --scale large --output bench_output.txt
+#   python bench_zri.py --real-models            # en_core_web_lg + VADER instead
+#   ZRI_NLP_MODE=full python bench_zri.py --real-models
+#
+# Synthetic users, cases and statements are generated from a fixed seed, so
+# two runs at the same scale time the same work. Each path reports latency
+# percentiles, throughput and the process's peak RSS after it ran; the whole
+# report is JSON so runs can be diffed over time.
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from zri_db import Database
+from zri_analysis import SentimentAnalysis
+from zri_lexical import LexicalPrefilter, compare_with_full_model
+from zri_vector_index import StatementIndex
+from zri_auth import AuthService, LoginRateLimiter
+from zri_archive import SegmentStore, archive_closed_cases
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SCALES = {
+    "small": {"users": 1000, "cases": 200, "participants": 6, "statements": 500, "pairs": 500,
+              "indexed_statements": 20000, "archived_answers": 20000},
+    "medium": {"users": 20000, "cases": 5000, "participants": 8, "statements": 2000, "pairs": 2000,
+               "indexed_statements": 200000, "archived_answers": 200000},
+    "large": {"users": 200000, "cases": 50000, "participants": 10, "statements": 10000, "pairs": 5000,
+              "indexed_statements": 1000000, "archived_answers": 1000000},
+}
+
+WORDS = ("saw heard car man woman street night morning ran shouted left right door window red blue "
+         "tall short knife phone bag store police quickly slowly afraid calm angry happy sad good "
+         "bad terrible great safe hurt help stole broke walked drove before after near behind").split()
+
+class StandInDoc(list):
+    # Just enough of spacy.tokens.Doc for SentimentAnalysis
+    def __init__(self, tokens, vector):
+        super().__init__(tokens)
+        self.vector = vector
+
+class StandInToken:
+    def __init__(self, text):
+        self.text = text
+
+class StandInVocab:
+    def __init__(self, width):
+        self.vectors_length = width
+
+class HashingVectorizer:
+    # Stand-in for the spaCy pipeline: every word gets a fixed pseudo-random
+    # vector derived from its hash and a document is the mean of its words,
+    # like en_core_web_lg's static vectors. No model download needed.
+    pipe_names = ("tok2vec", "tagger", "parser", "ner")
+    meta = {"name": "hashing_standin", "version": "1"}
+
+    def __init__(self, width=300):
+        self.vocab = StandInVocab(width)
+        self.word_vectors = {}
+
+    def word_vector(self, word):
+        vector = self.word_vectors.get(word)
+        if vector is None:
+            seed = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+            vector = np.random.default_rng(seed).standard_normal(self.vocab.vectors_length).astype(np.float32)
+            self.word_vectors[word] = vector
+        return vector
+
+    def __call__(self, text):
+        words = re.findall(r"\w+|[^\w\s]", text.lower())
+        if words:
+            vector = np.mean([self.word_vector(word) for word in words], axis=0)
+        else:
+            vector = np.zeros(self.vocab.vectors_length, dtype=np.float32)
+        return StandInDoc([StandInToken(word) for word in words], vector)
+
+    def pipe(self, texts, disable=()):
+        for text in texts:
+            yield self(text)
+
+class LexiconSentiment:
+    # Stand-in for VADER: summed word valences squashed the way VADER's
+    # compound score is
+    VALENCE = {"good": 1.9, "great": 3.1, "happy": 2.7, "calm": 1.3, "safe": 1.9, "help": 1.7,
+               "bad": -2.5, "terrible": -3.1, "afraid": -2.0, "angry": -2.3, "sad": -2.1,
+               "hurt": -2.4, "stole": -2.2, "broke": -1.5}
+
+    def polarity_scores(self, text):
+        score = sum(self.VALENCE.get(word, 0.0) for word in re.findall(r"\w+", text.lower()))
+        compound = score / (score * score + 15) ** 0.5
+        return {"neg": max(-compound, 0.0), "neu": 1 - abs(compound), "pos": max(compound, 0.0), "compound": compound}
+
+def make_statement(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 40))) + "."
+
+def make_variant(rng, text, edits):
+    # The statement with a few words replaced, as a retelling would
+    words = text.rstrip(".").split()
+    for _ in range(edits):
+        words[rng.randrange(len(words))] = rng.choice(WORDS)
+    return " ".join(words) + "."
+
+def make_tiered_pairs(rng, statements, count):
+    # A mix of clear-cut and ambiguous pairs: repeats, light retellings,
+    # unrelated statements in disjoint vocabulary and random pairs
+    half = len(WORDS) // 2
+    pairs = []
+    for i in range(count):
+        text = rng.choice(statements)
+        kind = i % 4
+        if kind == 0:
+            pairs.append((text, make_variant(rng, text, 0 if i % 8 == 0 else 1)))
+        elif kind == 1:
+            left = " ".join(rng.choice(WORDS[:half]) for _ in range(rng.randint(5, 20))) + "."
+            right = " ".join(rng.choice(WORDS[half:]) for _ in range(rng.randint(5, 20))) + "."
+            pairs.append((left, right))
+        elif kind == 2:
+            pairs.append((text, make_variant(rng, text, rng.randint(2, 8))))
+        else:
+            pairs.append((text, rng.choice(statements)))
+    return pairs
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def measure(name, calls, repeat_items):
+    # calls: zero-argument callables, one per operation; returns a result record
+    samples = []
+    started = time.perf_counter()
+    for call in calls:
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+    wall = time.perf_counter() - started
+    samples.sort()
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+    return {
+        "name": name,
+        "operations": len(samples),
+        "items": len(samples) * repeat_items,
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "max_ms": samples[-1] * 1000,
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "throughput_per_s": len(samples) * repeat_items / wall if wall else None,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+def build_database(db_file, scale, rng):
+    # Users, roles and cases in bulk; returns what the benchmarks need to pick from
+    db = Database(db_file)
+    with db.transaction() as cur:
+        cur.executemany("INSERT INTO Role (RoleName) VALUES (?)",
+                        [("Admin",), ("Witness",), ("Suspect",), ("Law Enforcer",)])
+        cur.executemany("INSERT INTO User (FirstName, LastName, Email, Password, RoleID) VALUES (?, ?, ?, ?, ?)",
+                        ((f"First{i}", f"Last{i}", f"user{i}@example.com", f"pw{i}", rng.randint(2, 4))
+                         for i in range(scale["users"])))
+    names = [f"First{i} Last{i}" for i in range(scale["users"])]
+    cases = []
+    for i in range(scale["cases"]):
+        people = rng.sample(names, scale["participants"])
+        third = max(len(people) // 3, 1)
+        cases.append((f"Case {i}: {make_statement(rng)}",
+                      {"Witness": people[:third], "Suspect": people[third:2 * third], "LawEnforcer": people[2 * third:]}))
+    db.add_cases(cases)
+    return db, names
+
+def bench_statement_index(directory, scale, seed, queries=200, width=300):
+    # Clustered synthetic document vectors, since building a large index
+    # from real statements would time the language model rather than the index
+    rng = np.random.default_rng(seed)
+    count = scale["indexed_statements"]
+    topics = rng.standard_normal((500, width)).astype(np.float32)
+    index = StatementIndex(directory, nlist=max(16, int(count ** 0.5) // 2), nprobe=16)
+    chunk = 20000
+    started = time.perf_counter()
+    for start in range(0, count, chunk):
+        size = min(chunk, count - start)
+        vectors = topics[rng.integers(0, len(topics), size)] + rng.standard_normal((size, width)).astype(np.float32)
+        index.add(range(start + 1, start + size + 1), rng.integers(1, scale["cases"] + 1, size).tolist(),
+                  rng.choice(["Witness", "Suspect"], size).tolist(), vectors)
+    build_seconds = time.perf_counter() - started
+
+    probes = topics[rng.integers(0, len(topics), queries)] + rng.standard_normal((queries, width)).astype(np.float32)
+    results = [
+        measure(f"index_query[{count}]", [lambda q=q: index.query(q, 10) for q in probes], 1),
+        measure(f"index_query[{count},suspect]", [lambda q=q: index.query(q, 10, roles=["Suspect"]) for q in probes], 1),
+        measure(f"index_query[{count},case]",
+                [lambda q=q: index.query(q, 10, case_ids=[int(rng.integers(1, scale["cases"] + 1))]) for q in probes], 1),
+    ]
+
+    # Recall@10 of the IVF search against an exact scan, on a subset of queries
+    recall = 0.0
+    sample = probes[:20]
+    for probe in sample:
+        unit = probe / np.linalg.norm(probe)
+        similarity = np.concatenate([np.asarray(index.vectors[start:start + 65536]) @ unit
+                                     for start in range(0, count, 65536)])
+        exact = set((np.argpartition(-similarity, 9)[:10] + 1).tolist())  # AnswerIDs start at 1
+        found = {answer_id for answer_id, _, _, _ in index.query(probe, 10)}
+        recall += len(found & exact) / 10
+    index.close()
+    return results, {"statements": count, "build_s": build_seconds, "recall_at_10": recall / len(sample)}
+
+def bench_archive(directory, scale, rng, reads=2000):
+    # Answers spread over every case, half of which are then closed and archived
+    db_file = os.path.join(directory, "archive.db")
+    db = Database(db_file, archive=SegmentStore(os.path.join(directory, "archive")))
+    with db.transaction() as cur:
+        cur.executemany("INSERT INTO Cases (CaseDescription) VALUES (?)", ((f"Case {i}",) for i in range(scale["cases"])))
+        cur.executemany('''INSERT INTO Answer (CaseID, UserID, QuestionIndex, Question, AnswerText, ConfidenceScore)
+                          VALUES (?, ?, ?, ?, ?, ?)''',
+                        ((i % scale["cases"] + 1, i % 7 + 1, i // scale["cases"], "Tell us what you saw.",
+                          " ".join(make_statement(rng) for _ in range(3)), rng.random())
+                         for i in range(scale["archived_answers"])))
+        cur.executemany("INSERT INTO CaseProgress (CaseID, Progress) VALUES (?, 'Closed')",
+                        ((case_id,) for case_id in range(1, scale["cases"] + 1, 2)))
+    db.vacuum()
+    before_bytes = os.path.getsize(db_file)
+    answer_ids = [rng.randint(1, scale["archived_answers"]) for _ in range(reads)]
+    results = [measure("answer_text[sqlite]", [lambda a=a: db.answer_texts([a]) for a in answer_ids], 1)]
+
+    started = time.perf_counter()
+    cases, statements = archive_closed_cases(db, db.archive)
+    archive_seconds = time.perf_counter() - started
+    db.vacuum()
+    results.append(measure("answer_text[sqlite+archive]", [lambda a=a: db.answer_texts([a]) for a in answer_ids], 1))
+    results.append(measure("case_summary[archived]",
+                           [lambda c=rng.randrange(1, scale["cases"] + 1, 2): db.case_summary(c) for _ in range(reads)], 1))
+    stats = db.archive.stats()
+    db.archive.close()
+    db.close_connection()
+    return results, {"cases": cases, "statements": statements, "archive_s": archive_seconds,
+                     "db_bytes_before": before_bytes, "db_bytes_after": os.path.getsize(db_file),
+                     "archive_bytes": stats["segment_bytes"] + stats["index_bytes"], "codec": stats["codec"]}
+
+def run(scale_name, real_models, seed):
+    scale = SCALES[scale_name]
+    rng = random.Random(seed)
+    results = []
+
+    if real_models:
+        analyzer = SentimentAnalysis()
+    else:
+        analyzer = SentimentAnalysis(nlp=HashingVectorizer(), sid=LexiconSentiment())
+    statements = [make_statement(rng) for _ in range(scale["statements"])]
+    pairs = [(rng.choice(statements), rng.choice(statements)) for _ in range(scale["pairs"])]
+
+    results.append(measure("calculate_emotion_score",
+                           [lambda text=text: analyzer.calculate_emotion_score(text) for text in statements], 1))
+    results.append(measure("calculate_consistency_score",
+                           [lambda a=a, b=b: analyzer.calculate_consistency_score(a, b) for a, b in pairs], 1))
+    case_statements = [statements[i:i + 50] for i in range(0, len(statements), 50)]
+    results.append(measure("calculate_consistency_matrix[50]",
+                           [lambda texts=texts: analyzer.calculate_consistency_matrix(texts) for texts in case_statements], 50 * 50))
+
+    # Tiered consistency: the lexical pre-filter in front of the same model
+    tiered_pairs = make_tiered_pairs(rng, statements, scale["pairs"])
+    # The unrelated-pair score is fitted to this model on half of the pairs;
+    # accuracy is reported on the other half
+    calibration_pairs, held_out_pairs = tiered_pairs[:len(tiered_pairs) // 2], tiered_pairs[len(tiered_pairs) // 2:]
+    prefilter = LexicalPrefilter()
+    prefilter.calibrate(calibration_pairs, [analyzer.calculate_consistency_score(a, b) for a, b in calibration_pairs])
+    tiered = SentimentAnalysis(nlp=analyzer.nlp, sid=analyzer.sid, prefilter=prefilter)
+    results.append(measure("consistency_score[full]",
+                           [lambda a=a, b=b: analyzer.calculate_consistency_score(a, b) for a, b in tiered_pairs], 1))
+    results.append(measure("consistency_score[tiered]",
+                           [lambda a=a, b=b: tiered.calculate_consistency_score(a, b) for a, b in tiered_pairs], 1))
+    results.append(measure("calculate_consistency_matrix[50,tiered]",
+                           [lambda texts=texts: tiered.calculate_consistency_matrix(texts) for texts in case_statements], 50 * 50))
+    tiered_accuracy = compare_with_full_model(analyzer, prefilter, held_out_pairs)
+    tiered_accuracy["unrelated_score"] = prefilter.unrelated_score
+
+    results.append(measure("calculate_confidence_score",
+                           [lambda: analyzer.calculate_confidence_score(rng.random(), rng.random())
+                            for _ in range(scale["pairs"])], 1))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index_results, statement_index = bench_statement_index(os.path.join(tmp, "index"), scale, seed)
+        results.extend(index_results)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Own generator, so the database benchmarks below see the same data as before
+        archive_results, archive = bench_archive(tmp, scale, random.Random(seed))
+        results.extend(archive_results)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_started = time.perf_counter()
+        db, names = build_database(os.path.join(tmp, "bench.db"), scale, rng)
+        setup_seconds = time.perf_counter() - setup_started
+        users = scale["users"]
+        lookups = min(users, 2000)
+
+        results.append(measure("login_lookup",
+                               [lambda u=rng.randrange(users): db.user_credentials(f"user{u}@example.com")
+                                for _ in range(lookups)], 1))
+
+        # Re-authentication from the verified-credentials cache; the first
+        # login per user (slow hash, plaintext upgrade) happens outside the timing
+        unlimited = LoginRateLimiter(rate=1e9, burst=1e9, per_key_rate=1e9, per_key_burst=1e9)
+        auth = AuthService(db, limiter=unlimited, iterations=1000)
+        returning = [rng.randrange(users) for _ in range(50)]
+        for u in returning:
+            auth.authenticate(f"user{u}@example.com", f"pw{u}")
+        results.append(measure("authenticate[cached]",
+                               [lambda u=rng.choice(returning): auth.authenticate(f"user{u}@example.com", f"pw{u}")
+                                for _ in range(lookups)], 1))
+
+        def add_case():
+            people = rng.sample(names, scale["participants"])
+            db.add_case(f"Bench case {make_statement(rng)}",
+                        {"Witness": people[:2], "Suspect": people[2:4], "LawEnforcer": people[4:]})
+
+        results.append(measure("add_case", [add_case for _ in range(200)], 1))
+
+        witness_ids = [row[0] for row in db.cur.execute("SELECT DISTINCT UserID FROM Witness LIMIT 500")]
+        results.append(measure("load_pending_cases[admin]",
+                               [lambda: db.pending_cases_page(limit=200) for _ in range(200)], 1))
+        results.append(measure("load_pending_cases[witness]",
+                               [lambda u=u: db.pending_cases_page("Witness", u, limit=200) for u in witness_ids], 1))
+        db.close_connection()
+
+    return {
+        "suite": "zeroreid",
+        "scale": scale_name,
+        "parameters": scale,
+        "seed": seed,
+        "models": (f"en_core_web_lg[{os.environ.get('ZRI_NLP_MODE', 'slim')}]+vader" if real_models
+                   else "hashing_standin+lexicon_standin"),
+        "database_setup_s": setup_seconds,
+        "tiered_accuracy": tiered_accuracy,
+        "statement_index": statement_index,
+        "archive": archive,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark scoring and database hot paths")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--real-models", action="store_true", help="use en_core_web_lg and VADER")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = run(args.scale, args.real_models, args.seed)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        for result in report["results"]:
+            print(f"{result['name']:<40} p50 {result['p50_ms']:8.3f} ms  p99 {result['p99_ms']:8.3f} ms"
+                  f"  {result['throughput_per_s']:12.0f}/s")
+        print("tiered accuracy:", json.dumps(report["tiered_accuracy"]))
+        print("statement index:", json.dumps(report["statement_index"]))
+        print("archive:", json.dumps(report["archive"]))
+    else:
+        print(text)
@@ -0,0 +1,56 @@
+import os
+import sys
+from concurrent.futures import Future
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zri_db import Database
+from zri_batch import BatchScorer
+
+class FixedScores:
+    # Stands in for ScoringService: every answer gets the same scores at once
+    def __init__(self):
+        self.scored = []
+
+    def submit(self, method, answers):
+        future = Future()
+        self.scored.extend(answer_id for answer_id, _, _ in answers)
+        future.set_result([(answer_id, {'emotion_score': 0.5, 'obedient': 'Y', 'self_consistency': None,
+                                        'case_consistency': None, 'confidence_score': 0.5})
+                           for answer_id, _, _ in answers])
+        return future
+
+def make_db(tmp_path):
+    db = Database(str(tmp_path / "batch.db"))
+    with db.transaction() as cur:
+        cur.executemany("INSERT INTO Role (RoleName) VALUES (?)", [("Witness",)])
+        cur.executemany("INSERT INTO User (FirstName, LastName, Email, Password, RoleID) VALUES (?, ?, ?, '', 1)",
+                        [(f"F{i}", f"L{i}", f"user{i}@example.com") for i in range(2)])
+    case_ids = [db.add_case(f"case {i}", {"Witness": ["F0 L0", "F1 L1"]}) for i in range(3)]
+    for case_id in case_ids:
+        for question in range(2):
+            db.add_answer(case_id, 1, question, f"Q{question}", f"answer {case_id} {question}")
+    return db, case_ids
+
+def unscored(db):
+    return db.conn.execute("SELECT COUNT(*) FROM Answer WHERE ConfidenceScore IS NULL").fetchone()[0]
+
+def test_answer_added_to_earlier_case_is_scored_by_next_run(tmp_path):
+    db, case_ids = make_db(tmp_path)
+    assert BatchScorer(db, FixedScores(), "job", chunk_cases=2, commit_every=1).run() == 6
+    assert db.batch_checkpoint("job") == (0, 0)
+
+    late = db.add_answer(case_ids[0], 2, 2, "Q2", "a late answer")
+    service = FixedScores()
+    assert BatchScorer(db, service, "job", chunk_cases=2, commit_every=1).run() == 1
+    assert late in service.scored
+    assert unscored(db) == 0
+
+def test_interrupted_run_resumes_after_checkpoint(tmp_path):
+    db, case_ids = make_db(tmp_path)
+    db.save_case_scores("job", [(case_ids[0], [])], 2)
+    service = FixedScores()
+    BatchScorer(db, service, "job").run()
+    first_case = {answer_id for answer_id, _, _ in db.case_answers(case_ids[0])}
+    assert not first_case & set(service.scored)
+    assert len(service.scored) == 4
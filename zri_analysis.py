@@ -0,0 +1,470 @@
+import sqlite3
+import hashlib
+import json
+import threading
+import logging
+import os
+import queue
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from zri_metrics import metrics, InstrumentedConnection
+from zri_nlp import load_pipeline
+
+# spaCy and NLTK are only needed for the real models; benchmarks and tests can
+# run SentimentAnalysis on stand-ins without them installed
+try:
+    import nltk
+    from nltk.sentiment import SentimentIntensityAnalyzer
+except ImportError:
+    nltk = None
+try:
+    import spacy
+except ImportError:
+    spacy = None
+
+logger = logging.getLogger("zeroreid")
+
+class StatementCache:
+    # Per-statement analysis results (document vector, token key and VADER
+    # polarity scores) keyed by a hash of the statement text and model version.
+    # A small in-process LRU sits in front of a StatementCache table so
+    # re-scoring a case only pays for statements that have not been seen.
+    # scope names the NLP mode (the pipeline's name); processes running other
+    # modes share the table, and only rows of this scope are ever purged.
+    # The table is created by zri_db.Database's migrations, so db_file must
+    # have been opened through Database first.
+    def __init__(self, db_file, model_version, capacity=4096, scope=None):
+        self.model_version = model_version
+        self.scope = scope or model_version
+        self.capacity = capacity
+        self.hot = OrderedDict()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, factory=InstrumentedConnection)
+        # Entries written by an older version of this mode's model are stale;
+        # so are rows from before scopes were recorded
+        self.conn.execute("DELETE FROM StatementCache WHERE (Scope = ? OR Scope IS NULL) AND ModelVersion != ?",
+                          (self.scope, model_version))
+        self.conn.commit()
+
+    def key(self, text):
+        digest = hashlib.sha256()
+        digest.update(self.model_version.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get_many(self, texts):
+        # Returns {text: entry} for every cached text; misses are left out
+        found = {}
+        missing = {}
+        with self.lock:
+            for text in texts:
+                key = self.key(text)
+                entry = self.hot.get(key)
+                if entry is not None:
+                    self.hot.move_to_end(key)
+                    found[text] = entry
+                else:
+                    missing[key] = text
+            metrics.count("cache.hot_hits", len(found))
+
+            keys = list(missing)
+            db_hits = 0
+            # Stay well below SQLITE_MAX_VARIABLE_NUMBER
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT TextHash, Vector, TokenKey, Polarity FROM StatementCache WHERE TextHash IN ({placeholders})",
+                    chunk).fetchall()
+                for key, vector, token_key, polarity in rows:
+                    entry = {
+                        'vector': np.frombuffer(vector, dtype=np.float32) if vector is not None else None,
+                        'token_key': token_key,
+                        'polarity': json.loads(polarity) if polarity is not None else None,
+                    }
+                    self.remember(key, entry)
+                    found[missing[key]] = entry
+                    db_hits += 1
+            metrics.count("cache.db_hits", db_hits)
+            metrics.count("cache.misses", len(missing) - db_hits)
+        return found
+
+    def get(self, text):
+        return self.get_many([text]).get(text)
+
+    def put_many(self, entries):
+        # entries maps text -> dict with any of 'vector', 'token_key', 'polarity';
+        # fields that are not given keep their stored value. An entry that is
+        # already hot is updated in place and keeps its place in the LRU.
+        rows = []
+        with self.lock:
+            for text, fields in entries.items():
+                key = self.key(text)
+                entry = self.hot.get(key)
+                if entry is None:
+                    entry = {'vector': None, 'token_key': None, 'polarity': None}
+                    self.remember(key, entry)
+                entry.update(fields)
+                if entry['vector'] is not None:
+                    entry['vector'] = np.asarray(entry['vector'], dtype=np.float32)
+                rows.append((
+                    key,
+                    self.model_version,
+                    self.scope,
+                    entry['vector'].tobytes() if entry['vector'] is not None else None,
+                    entry['token_key'],
+                    json.dumps(entry['polarity']) if entry['polarity'] is not None else None,
+                ))
+            self.conn.executemany('''INSERT INTO StatementCache (TextHash, ModelVersion, Scope, Vector, TokenKey, Polarity)
+                                        VALUES (?, ?, ?, ?, ?, ?)
+                                        ON CONFLICT(TextHash) DO UPDATE SET
+                                            Vector = COALESCE(excluded.Vector, Vector),
+                                            TokenKey = COALESCE(excluded.TokenKey, TokenKey),
+                                            Polarity = COALESCE(excluded.Polarity, Polarity)''', rows)
+            self.conn.commit()
+
+    def remember(self, key, entry):
+        self.hot[key] = entry
+        self.hot.move_to_end(key)
+        while len(self.hot) > self.capacity:
+            self.hot.popitem(last=False)
+
+    def close(self):
+        self.conn.close()
+
+class SentimentAnalysis:
+    # Pipeline components needed to build document vectors. en_core_web_lg
+    # averages static token vectors, so the tokenizer alone is enough and
+    # tagger/parser/ner can be skipped when scoring consistency.
+    VECTOR_COMPONENTS = ()
+
+    def __init__(self, cache_file=None, nlp=None, sid=None, prefilter=None):
+        # nlp and sid replace the spaCy pipeline and VADER analyzer, e.g. with
+        # the offline stand-ins used by the benchmarks. prefilter is an optional
+        # zri_lexical.LexicalPrefilter that settles clear-cut pairs without vectors.
+        if sid is None and nltk is None:
+            raise ImportError("nltk is required unless a sentiment analyzer is supplied")
+        if nlp is None and spacy is None:
+            raise ImportError("spaCy is required unless an nlp pipeline is supplied")
+        # Initialize NLTK Sentiment Intensity Analyzer
+        self.sid = sid if sid is not None else SentimentIntensityAnalyzer()
+        # Initialize spaCy NLP model, slim by default (see zri_nlp and ZRI_NLP_MODE)
+        self.nlp = nlp if nlp is not None else load_pipeline()
+        # Optional persistent cache of vectors and polarity scores per statement
+        self.cache = (StatementCache(cache_file, self.model_version(), scope=self.nlp.meta['name'])
+                      if cache_file else None)
+        self.prefilter = prefilter
+
+    def model_version(self):
+        # Identifies everything that influences cached results
+        if nltk is not None and isinstance(self.sid, SentimentIntensityAnalyzer):
+            sentiment = f"vader:nltk-{nltk.__version__}"
+        else:
+            sentiment = f"sentiment:{type(self.sid).__name__}"
+        return f"spacy:{self.nlp.meta['name']}-{self.nlp.meta['version']};{sentiment}"
+
+    @metrics.timed("analysis.polarity_scores")
+    def polarity_scores(self, text):
+        if self.cache is None:
+            return self.sid.polarity_scores(text)
+        return self.polarity_scores_many([text])[text]
+
+    @metrics.timed("analysis.polarity_scores_many")
+    def polarity_scores_many(self, texts):
+        # {text: VADER scores} with one cache read and at most one cache write
+        texts = list(dict.fromkeys(texts))
+        if self.cache is None:
+            return {text: self.sid.polarity_scores(text) for text in texts}
+        cached = self.cache.get_many(texts)
+        results = {text: entry['polarity'] for text, entry in cached.items() if entry['polarity'] is not None}
+        fresh = {text: {'polarity': self.sid.polarity_scores(text)} for text in texts if text not in results}
+        if fresh:
+            self.cache.put_many(fresh)
+            results.update((text, fields['polarity']) for text, fields in fresh.items())
+        return results
+
+    @metrics.timed("analysis.is_obedient")
+    def is_obedient(self, text, name, age, gender):
+        # Sentiment analysis for obedience
+        # You can define your own rules for determining obedience based on sentiment scores
+        sentiment_scores = self.polarity_scores(text)
+        obedient_score = sentiment_scores['compound']
+        if obedient_score >= 0:
+            return 'Y'  # Obedient
+        else:
+            return 'N'  # Not obedient
+
+    @metrics.timed("analysis.calculate_emotion_score")
+    def calculate_emotion_score(self, text):
+        # Calculate emotion score
+        sentiment_scores = self.polarity_scores(text)
+        emotion_score = sentiment_scores['compound']
+        return emotion_score
+
+    @metrics.timed("analysis.calculate_consistency_score")
+    def calculate_consistency_score(self, text1, text2):
+        # Calculate consistency score based on two sets of text
+        # Routed through the batch engine so a single pair only pays for tokenization
+        return float(self.calculate_consistency_matrix([text1, text2])[0, 1])
+
+    @metrics.timed("analysis.document_vectors")
+    def document_vectors(self, texts):
+        # Parse every text once in a single streamed pass, keeping only the
+        # components that contribute to Doc.vector. Cached statements are
+        # not parsed again.
+        texts = list(texts)
+        cached = self.cache.get_many(texts) if self.cache is not None else {}
+        results = {text: (entry['vector'], entry['token_key'])
+                   for text, entry in cached.items() if entry['vector'] is not None}
+
+        pending = list(dict.fromkeys(text for text in texts if text not in results))
+        if pending:
+            disabled = [name for name in self.nlp.pipe_names if name not in self.VECTOR_COMPONENTS]
+            fresh = {}
+            for text, doc in zip(pending, self.nlp.pipe(pending, disable=disabled)):
+                token_key = hashlib.sha1("\0".join(token.text for token in doc).encode("utf-8")).hexdigest()
+                results[text] = (doc.vector, token_key)
+                fresh[text] = {'vector': doc.vector, 'token_key': token_key}
+            if self.cache is not None:
+                self.cache.put_many(fresh)
+
+        width = self.nlp.vocab.vectors_length
+        matrix = np.asarray([results[text][0] for text in texts], dtype=np.float32).reshape(len(texts), width)
+        token_keys = [results[text][1] for text in texts]
+        return matrix, token_keys
+
+    def consistency_block(self, vectors_a, keys_a, vectors_b, keys_b):
+        # Consistency between every row of A and every row of B: cosine
+        # similarity of the document vectors normalized to [0, 1].
+        def unit_rows(vectors):
+            norms = np.linalg.norm(vectors, axis=1)
+            nonzero = norms > 0
+            unit = np.zeros_like(vectors)
+            unit[nonzero] = vectors[nonzero] / norms[nonzero, None]
+            return unit, nonzero
+
+        unit_a, nonzero_a = unit_rows(vectors_a)
+        unit_b, nonzero_b = unit_rows(vectors_b)
+        similarity = unit_a @ unit_b.T
+
+        # Doc.similarity treats identical token sequences as a perfect match
+        # and anything without a vector as 0.0; keep the same semantics here.
+        similarity[~nonzero_a, :] = 0.0
+        similarity[:, ~nonzero_b] = 0.0
+        rows_by_key = {}
+        for index, key in enumerate(keys_b):
+            rows_by_key.setdefault(key, []).append(index)
+        for index, key in enumerate(keys_a):
+            if key in rows_by_key:
+                similarity[index, rows_by_key[key]] = 1.0
+
+        np.clip(similarity, -1.0, 1.0, out=similarity)
+        return (similarity + 1) / 2  # Normalize to [0, 1]
+
+    def consistency_between(self, texts_a, texts_b):
+        # Consistency of every text in A with every text in B. With a
+        # prefilter, only statements involved in at least one pair it cannot
+        # settle are vectorized, and only those pairs take the model's score.
+        texts_a = list(texts_a)
+        texts_b = list(texts_b)
+        if self.prefilter is None:
+            vectors, token_keys = self.document_vectors(texts_a + texts_b)
+            split = len(texts_a)
+            return self.consistency_block(vectors[:split], token_keys[:split], vectors[split:], token_keys[split:])
+
+        scores, ambiguous = self.prefilter.decide(texts_a, texts_b)
+        rows = np.flatnonzero(ambiguous.any(axis=1))
+        columns = np.flatnonzero(ambiguous.any(axis=0))
+        if len(rows):
+            vectors, token_keys = self.document_vectors([texts_a[i] for i in rows] + [texts_b[j] for j in columns])
+            split = len(rows)
+            block = self.consistency_block(vectors[:split], token_keys[:split], vectors[split:], token_keys[split:])
+            sub = np.ix_(rows, columns)
+            scores[sub] = np.where(ambiguous[sub], block, scores[sub])
+        return scores
+
+    @metrics.timed("analysis.calculate_consistency_matrix")
+    def calculate_consistency_matrix(self, texts):
+        # Pairwise consistency scores for all statements on a case.
+        # Entry [i, j] matches calculate_consistency_score(texts[i], texts[j]).
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        if self.prefilter is not None:
+            return self.consistency_between(texts, texts)
+        vectors, token_keys = self.document_vectors(texts)
+        return self.consistency_block(vectors, token_keys, vectors, token_keys)
+
+    @metrics.timed("analysis.calculate_consistency_scores")
+    def calculate_consistency_scores(self, text, others):
+        # Consistency of one statement against each of many, without the full matrix
+        others = list(others)
+        if not others:
+            return np.zeros(0, dtype=np.float32)
+        return self.consistency_between([text], others)[0]
+
+    def answer_scores(self, text, self_scores, case_scores, name=None, age=None, gender=None):
+        # Scoring core shared by score_answer and score_case_answers. The
+        # consistency arrays hold the answer's score against each of the
+        # witness's earlier answers and against each other witness's answer
+        # on the case. With nothing to compare against yet, consistency is
+        # 1.0 (nothing contradicts it).
+        self_consistency = float(self_scores.mean()) if len(self_scores) else None
+        case_consistency = float(case_scores.mean()) if len(case_scores) else None
+        available = [score for score in (self_consistency, case_consistency) if score is not None]
+        consistency_score = sum(available) / len(available) if available else 1.0
+        emotion_score = self.calculate_emotion_score(text)
+        return {
+            'emotion_score': emotion_score,
+            'obedient': self.is_obedient(text, name, age, gender),
+            'self_consistency': self_consistency,
+            'case_consistency': case_consistency,
+            'confidence_score': self.calculate_confidence_score(emotion_score, consistency_score),
+        }
+
+    @metrics.timed("analysis.score_answer")
+    def score_answer(self, answer, earlier_answers=(), other_answers=(), name=None, age=None, gender=None):
+        # All scores for one interrogation answer: emotion, obedience, mean
+        # consistency with the witness's earlier answers and with other
+        # witnesses' answers, and the resulting confidence. Callers pass the
+        # answers recorded on the case before this one (Database.answer_context),
+        # the same set score_case_answers uses, so a rescore reproduces it.
+        earlier_answers = list(earlier_answers)
+        other_answers = list(other_answers)
+        scores = self.calculate_consistency_scores(answer, earlier_answers + other_answers)
+        split = len(earlier_answers)
+        return self.answer_scores(answer, scores[:split], scores[split:], name, age, gender)
+
+    @metrics.timed("analysis.score_case_answers")
+    def score_case_answers(self, answers):
+        # Batch form of score_answer for every answer on one case, from a
+        # single vector pass and one consistency matrix. answers is a list of
+        # (AnswerID, UserID, text) in AnswerID order; like score_answer, each
+        # answer is compared only with the answers recorded before it.
+        answers = list(answers)
+        if not answers:
+            return []
+        matrix = self.calculate_consistency_matrix([text for _, _, text in answers])
+        if self.cache is not None:
+            # One cache round trip for the case; the per-answer lookups below then hit memory
+            self.polarity_scores_many(text for _, _, text in answers)
+        user_ids = np.array([user_id for _, user_id, _ in answers])
+        positions = np.arange(len(answers))
+
+        results = []
+        for index, (answer_id, user_id, text) in enumerate(answers):
+            same_user = user_ids == user_id
+            before = positions < index
+            row = matrix[index]
+            results.append((answer_id, self.answer_scores(text, row[same_user & before], row[~same_user & before])))
+        return results
+
+    @metrics.timed("analysis.calculate_confidence_score")
+    def calculate_confidence_score(self, emotion_score, consistency_score):
+        # Calculate confidence score as an average of emotion and consistency scores
+        confidence_score = (emotion_score + consistency_score) / 2
+        return confidence_score
+
+def ensure_vader_lexicon():
+    # Only reach for the network when the lexicon is not installed yet
+    try:
+        nltk.data.find('sentiment/vader_lexicon.zip')
+    except LookupError:
+        nltk.download('vader_lexicon', quiet=True)
+
+# Scoring methods the worker pool is allowed to run
+SCORING_METHODS = (
+    'is_obedient',
+    'calculate_emotion_score',
+    'calculate_consistency_score',
+    'calculate_consistency_matrix',
+    'calculate_consistency_scores',
+    'calculate_confidence_score',
+    'score_answer',
+    'score_case_answers',
+)
+
+# One warm analyzer per worker process, built by the pool initializer
+_worker_analyzer = None
+
+def _init_scoring_worker(cache_file, prefilter):
+    # The parent has already made sure the VADER lexicon is installed
+    global _worker_analyzer
+    _worker_analyzer = SentimentAnalysis(cache_file=cache_file, prefilter=prefilter)
+
+def _run_scoring_task(method, args):
+    return getattr(_worker_analyzer, method)(*args)
+
+def scoring_workers(default):
+    # ZRI_SCORING_WORKERS overrides the caller's default pool size
+    return int(os.environ.get("ZRI_SCORING_WORKERS", 0)) or default
+
+class ScoringService:
+    # Runs SentimentAnalysis in a pool of worker processes so scoring never
+    # blocks the caller. Each worker loads the models once and keeps them.
+    # At most max_in_flight tasks are queued or running at a time; submit()
+    # waits (or raises queue.Full when block=False) beyond that. The pool is
+    # started on first use and replaced when a crashed worker has broken it.
+    def __init__(self, workers=None, max_in_flight=None, cache_file=None, prefilter=None):
+        if workers is None:
+            workers = scoring_workers(os.cpu_count() or 1)
+        self.workers = workers
+        self.max_in_flight = max_in_flight or workers * 4
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.cache_file = cache_file
+        self.prefilter = prefilter
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def pool(self):
+        with self.lock:
+            if self.executor is None:
+                if nltk is not None:
+                    # Once here rather than in every worker
+                    ensure_vader_lexicon()
+                # spawn rather than fork: the parent may already be running Qt threads
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_scoring_worker,
+                    initargs=(self.cache_file, self.prefilter),
+                )
+            return self.executor
+
+    def restart(self, broken):
+        # Drop the broken pool; the next submit starts a new one. Another
+        # thread may already have replaced it, so only `broken` is dropped.
+        with self.lock:
+            if self.executor is not broken:
+                return
+            self.executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+        logger.warning("A scoring worker died; starting a new pool")
+
+    def submit(self, method, *args, block=True, timeout=None):
+        if method not in SCORING_METHODS:
+            raise ValueError(f"Unknown scoring method: {method}")
+        if not self.slots.acquire(blocking=block, timeout=timeout if block else None):
+            raise queue.Full(f"{self.max_in_flight} scoring requests already in flight")
+        try:
+            executor = self.pool()
+            try:
+                future = executor.submit(_run_scoring_task, method, args)
+            except BrokenProcessPool:
+                self.restart(executor)
+                future = self.pool().submit(_run_scoring_task, method, args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
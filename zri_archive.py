@@ -0,0 +1,355 @@
+# Compressed, append-only store for the answers of closed cases.
+#
+#   python zri_archive.py archive --vacuum     # move closed cases out of sqlite
+#   python zri_archive.py show 1234            # print one archived answer
+#   python zri_archive.py stats
+#
+# Transcripts and per-answer scores of a closed case are read rarely but make
+# up most of the database, and their long TEXT rows spread the hot tables over
+# more pages. Archiving writes a case's answers to the current segment file as
+# compressed frames of up to FRAME_STATEMENTS answers, then deletes them from
+# Answer in one transaction. CaseSummary rows stay in sqlite, so overviews of
+# archived cases still cost one indexed read.
+#
+# Segments are only ever appended to and are read through mmap; index.dat
+# maps each AnswerID to its segment, frame offset and slot in the frame.
+# Reading an answer decompresses one frame, and recently used frames are kept
+# decompressed. Frames are compressed with zstd when the zstandard package is
+# installed and with zlib otherwise; either store can read both.
+#
+# A crash after a frame is written but before sqlite commits leaves the case
+# in both places. It is archived again on the next run and the index entry
+# written last wins; the earlier frame is dead space.
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from zri_metrics import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("zeroreid")
+
+# Answer columns kept per archived statement, in frame order
+FIELDS = ("AnswerID", "UserID", "QuestionIndex", "Question", "AnswerText", "SubmittedAt", "EmotionScore",
+          "Obedient", "SelfConsistency", "CaseConsistency", "ConfidenceScore")
+
+# Magic, format version, codec, CaseID, uncompressed length, stored length, CRC32 of the uncompressed payload
+FRAME_HEADER = struct.Struct("<4sBBxxqIII")
+FRAME_MAGIC = b"ZRAF"
+FRAME_VERSION = 1
+CODECS = {"zlib": 1, "zstd": 2}
+
+INDEX_DTYPE = np.dtype([('answer_id', '<i8'), ('case_id', '<i8'), ('offset', '<u8'),
+                        ('segment', '<u4'), ('slot', '<u4'), ('length', '<u4'), ('reserved', '<u4')])
+
+CLOSED_PROGRESS = "Closed"
+
+class ArchiveCorruptError(ValueError):
+    pass
+
+class SegmentStore:
+    FRAME_STATEMENTS = 64
+
+    def __init__(self, directory, codec=None, segment_bytes=64 << 20, cache_frames=32):
+        self.directory = directory
+        self.codec = codec or ("zstd" if zstandard is not None else "zlib")
+        if self.codec not in CODECS:
+            raise ValueError(f"Unknown codec: {self.codec!r} (expected {' or '.join(CODECS)})")
+        if self.codec == "zstd" and zstandard is None:
+            raise ImportError("The zstandard package is required for zstd frames")
+        self.segment_bytes = segment_bytes
+        self.cache_frames = cache_frames
+        self.lock = threading.RLock()
+        self.maps = {}
+        self.frames = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        segments = sorted(int(name[8:14]) for name in os.listdir(directory)
+                          if name.startswith("segment-") and name.endswith(".zra"))
+        self.segment = segments[-1] if segments else 1
+        self.load_index()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def segment_path(self, segment):
+        return self.path(f"segment-{segment:06d}.zra")
+
+    def load_index(self):
+        # Entries are appended in archive order; lookups go through a sorted
+        # copy of the AnswerIDs. A torn last entry from a crash is dropped.
+        path = self.path("index.dat")
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size % INDEX_DTYPE.itemsize:
+            with open(path, "r+b") as f:
+                f.truncate(size - size % INDEX_DTYPE.itemsize)
+            size -= size % INDEX_DTYPE.itemsize
+        count = size // INDEX_DTYPE.itemsize
+        self.entries = (np.memmap(path, dtype=INDEX_DTYPE, mode="r", shape=(count,)) if count
+                        else np.zeros(0, dtype=INDEX_DTYPE))
+        # The sorted arrays are views into buffers with room to grow, so
+        # merging in appended entries rarely reallocates
+        self.order_buffer = np.argsort(self.entries['answer_id'], kind="stable")
+        self.id_buffer = np.asarray(self.entries['answer_id'])[self.order_buffer]
+        self.order = self.order_buffer[:count]
+        self.sorted_ids = self.id_buffer[:count]
+
+    def sync_index(self):
+        # Merges entries appended to index.dat since it was last read, by
+        # this process or another one, into the sorted lookup arrays. Each
+        # new entry goes after existing ones with the same AnswerID, so the
+        # latest still wins. Only the part of the arrays past the first
+        # insertion point moves, which for newly closed cases is usually
+        # nothing. Called with the lock held.
+        path = self.path("index.dat")
+        count = (os.path.getsize(path) if os.path.exists(path) else 0) // INDEX_DTYPE.itemsize
+        known = len(self.entries)
+        if count == known:
+            return
+        if count < known:
+            # Replaced or truncated underneath us
+            self.load_index()
+            return
+        self.entries = np.memmap(path, dtype=INDEX_DTYPE, mode="r", shape=(count,))
+        new_ids = np.asarray(self.entries['answer_id'][known:])
+        arrival = np.argsort(new_ids, kind="stable")
+        new_ids = new_ids[arrival]
+        at = np.searchsorted(self.sorted_ids, new_ids, side="right")
+        if count > len(self.id_buffer):
+            capacity = max(count, 2 * len(self.id_buffer))
+            self.id_buffer = np.concatenate([self.sorted_ids, np.empty(capacity - known, dtype=self.id_buffer.dtype)])
+            self.order_buffer = np.concatenate([self.order, np.empty(capacity - known, dtype=self.order_buffer.dtype)])
+        first = int(at[0])
+        moved_ids = self.id_buffer[first:known].copy()
+        moved_order = self.order_buffer[first:known].copy()
+        slots = at - first + np.arange(len(new_ids))
+        kept = np.ones(count - first, dtype=bool)
+        kept[slots] = False
+        ids = self.id_buffer[first:count]
+        ids[kept] = moved_ids
+        ids[slots] = new_ids
+        order = self.order_buffer[first:count]
+        order[kept] = moved_order
+        order[slots] = known + arrival
+        self.sorted_ids = self.id_buffer[:count]
+        self.order = self.order_buffer[:count]
+
+    def __len__(self):
+        with self.lock:
+            self.sync_index()
+            return len(np.unique(self.sorted_ids))
+
+    def __contains__(self, answer_id):
+        with self.lock:
+            self.sync_index()
+            return self.find([answer_id])[0] >= 0
+
+    def compress(self, data):
+        if self.codec == "zstd":
+            return zstandard.ZstdCompressor(level=10).compress(data)
+        return zlib.compress(data, 9)
+
+    @staticmethod
+    def decompress(codec, data, raw_length):
+        if codec == CODECS["zstd"]:
+            if zstandard is None:
+                raise ImportError("The zstandard package is required to read zstd frames")
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=raw_length)
+        return zlib.decompress(data)
+
+    @metrics.timed("archive.append")
+    def append_case(self, case_id, rows):
+        # rows: tuples in FIELDS order. Frames and their index entries are on
+        # disk when this returns.
+        rows = [list(row) for row in rows]
+        if not rows:
+            return 0
+        with self.lock:
+            path = self.segment_path(self.segment)
+            if os.path.exists(path) and os.path.getsize(path) >= self.segment_bytes:
+                self.segment += 1
+                path = self.segment_path(self.segment)
+            entries = np.zeros(len(rows), dtype=INDEX_DTYPE)
+            with open(path, "ab") as f:
+                offset = f.tell()
+                for start in range(0, len(rows), self.FRAME_STATEMENTS):
+                    chunk = rows[start:start + self.FRAME_STATEMENTS]
+                    payload = json.dumps(chunk, separators=(",", ":")).encode("utf-8")
+                    stored = self.compress(payload)
+                    frame = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, CODECS[self.codec], case_id,
+                                              len(payload), len(stored), zlib.crc32(payload)) + stored
+                    f.write(frame)
+                    block = entries[start:start + len(chunk)]
+                    block['answer_id'] = [row[0] for row in chunk]
+                    block['offset'] = offset
+                    block['slot'] = np.arange(len(chunk))
+                    block['length'] = len(frame)
+                    offset += len(frame)
+                    metrics.count("archive.bytes_raw", len(payload))
+                    metrics.count("archive.bytes_stored", len(frame))
+                f.flush()
+                os.fsync(f.fileno())
+            entries['case_id'] = case_id
+            entries['segment'] = self.segment
+            with open(self.path("index.dat"), "ab") as f:
+                f.write(entries.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self.sync_index()
+        metrics.count("archive.statements_written", len(rows))
+        return len(rows)
+
+    def find(self, answer_ids):
+        # Index entry position per AnswerID, or -1; the latest entry wins
+        answer_ids = np.asarray(list(answer_ids), dtype=np.int64)
+        if not len(self.sorted_ids):
+            return np.full(len(answer_ids), -1)
+        positions = np.maximum(np.searchsorted(self.sorted_ids, answer_ids, side="right") - 1, 0)
+        return np.where(self.sorted_ids[positions] == answer_ids, self.order[positions], -1)
+
+    def segment_map(self, segment, end):
+        # The segment's mmap, remapped when it has grown past the last mapping
+        mapped = self.maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            if mapped is not None:
+                mapped.close()
+            with open(self.segment_path(segment), "rb") as f:
+                mapped = self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapped
+
+    def frame(self, segment, offset, length):
+        # Decoded rows of one frame, through the recently-used cache
+        key = (segment, offset)
+        rows = self.frames.get(key)
+        if rows is not None:
+            self.frames.move_to_end(key)
+            metrics.count("archive.frame_cache_hits")
+            return rows
+        mapped = self.segment_map(segment, offset + length)
+        magic, version, codec, _, raw_length, stored_length, checksum = FRAME_HEADER.unpack_from(mapped, offset)
+        if magic != FRAME_MAGIC or version != FRAME_VERSION or FRAME_HEADER.size + stored_length != length:
+            raise ArchiveCorruptError(f"Bad frame header in segment {segment} at offset {offset}")
+        start = offset + FRAME_HEADER.size
+        payload = self.decompress(codec, mapped[start:start + stored_length], raw_length)
+        if zlib.crc32(payload) != checksum:
+            raise ArchiveCorruptError(f"Checksum mismatch in segment {segment} at offset {offset}")
+        rows = json.loads(payload)
+        self.frames[key] = rows
+        while len(self.frames) > self.cache_frames:
+            self.frames.popitem(last=False)
+        metrics.count("archive.frames_decoded")
+        return rows
+
+    def record(self, entry):
+        row = self.frame(int(entry['segment']), int(entry['offset']), int(entry['length']))[int(entry['slot'])]
+        record = dict(zip(FIELDS, row))
+        record["CaseID"] = int(entry['case_id'])
+        return record
+
+    @metrics.timed("archive.read")
+    def statements(self, answer_ids):
+        # {AnswerID: record} for the archived answers among answer_ids; a
+        # record is a dict of FIELDS plus CaseID
+        answer_ids = list(answer_ids)
+        with self.lock:
+            self.sync_index()
+            positions = self.find(answer_ids)
+            return {answer_id: self.record(self.entries[position])
+                    for answer_id, position in zip(answer_ids, positions) if position >= 0}
+
+    def statement(self, answer_id):
+        return self.statements([answer_id]).get(answer_id)
+
+    def case_statements(self, case_id):
+        # Every archived answer of a case, in AnswerID order
+        with self.lock:
+            self.sync_index()
+            answer_ids = np.unique(np.asarray(self.entries['answer_id'])[np.asarray(self.entries['case_id']) == case_id])
+        records = self.statements(answer_ids.tolist())
+        return [records[answer_id] for answer_id in answer_ids.tolist()]
+
+    def stats(self):
+        with self.lock:
+            self.sync_index()
+        segments = sorted(name for name in os.listdir(self.directory) if name.endswith(".zra"))
+        return {
+            "codec": self.codec,
+            "segments": len(segments),
+            "statements": len(self),
+            "cases": int(len(np.unique(np.asarray(self.entries['case_id'])))),
+            "segment_bytes": sum(os.path.getsize(self.path(name)) for name in segments),
+            "index_bytes": int(self.entries.nbytes),
+        }
+
+    def close(self):
+        with self.lock:
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps = {}
+            self.frames.clear()
+
+@metrics.timed("archive.archive_closed_cases")
+def archive_closed_cases(db, store, progress=CLOSED_PROGRESS, limit=None, chunk=100):
+    # Moves the answers of every case whose latest progress is `progress`
+    # into the store; returns (cases archived, statements archived)
+    cases = statements = 0
+    after_case_id = 0
+    while limit is None or cases < limit:
+        case_ids = db.archivable_cases(progress, after_case_id, chunk if limit is None else min(chunk, limit - cases))
+        if not case_ids:
+            break
+        for case_id in case_ids:
+            rows = db.answers_for_archive(case_id)
+            store.append_case(case_id, rows)
+            if db.mark_case_archived(case_id, [row[0] for row in rows]):
+                cases += 1
+                statements += len(rows)
+            else:
+                # Answers changed while the frames were written; they are archived again next run
+                logger.warning("Case %d changed while archiving; left in the database", case_id)
+        after_case_id = case_ids[-1]
+    metrics.count("archive.cases_archived", cases)
+    return cases, statements
+
+if __name__ == "__main__":
+    from zri_db import Database
+
+    parser = argparse.ArgumentParser(description="Move closed cases' answers into the compressed archive")
+    parser.add_argument("command", choices=("archive", "show", "stats"))
+    parser.add_argument("answer_id", nargs="?", type=int, help="AnswerID to print (show)")
+    parser.add_argument("--db", default="witness_submission_system.db")
+    parser.add_argument("--archive", default="statement_archive", help="archive directory")
+    parser.add_argument("--progress", default=CLOSED_PROGRESS, help="progress state of cases to archive")
+    parser.add_argument("--limit", type=int, help="archive at most this many cases")
+    parser.add_argument("--vacuum", action="store_true", help="shrink the database file afterwards")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    store = SegmentStore(args.archive)
+    try:
+        if args.command == "archive":
+            db = Database(args.db, archive=store)
+            try:
+                cases, statements = archive_closed_cases(db, store, args.progress, args.limit)
+                logger.info("Archived %d statements from %d cases", statements, cases)
+                if args.vacuum:
+                    db.vacuum()
+            finally:
+                db.close_connection()
+        elif args.command == "show":
+            print(json.dumps(store.statement(args.answer_id), indent=2))
+        else:
+            print(json.dumps(store.stats()))
+    finally:
+        store.close()
@@ -0,0 +1,187 @@
+# Authentication for the login and signup windows, no Qt required.
+#
+# Passwords are stored as salted PBKDF2-SHA256 hashes. The iteration count is
+# tunable through ZRI_PASSWORD_ITERATIONS; stored hashes with a different
+# count, and plaintext passwords left by older versions, are rehashed the
+# next time their owner logs in. Hashing is deliberately slow, so callers
+# should run authenticate() and register() off the UI thread.
+#
+# After a successful login the credentials are remembered for a while as a
+# keyed digest, so logging in again skips the slow hash. Token buckets, one
+# shared and one per email address, cap how fast login attempts are served.
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from zri_metrics import metrics
+
+HASH_ALGORITHM = "pbkdf2_sha256"
+DEFAULT_ITERATIONS = 600000
+
+class AuthenticationError(ValueError):
+    pass
+
+class RateLimitedError(AuthenticationError):
+    def __init__(self, retry_after):
+        super().__init__(f"Too many login attempts. Try again in {retry_after:.0f} seconds.")
+        self.retry_after = retry_after
+
+def password_iterations():
+    return int(os.environ.get("ZRI_PASSWORD_ITERATIONS", 0)) or DEFAULT_ITERATIONS
+
+def hash_password(password, iterations=None):
+    iterations = iterations or password_iterations()
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return "$".join((HASH_ALGORITHM, str(iterations), base64.b64encode(salt).decode("ascii"),
+                     base64.b64encode(digest).decode("ascii")))
+
+def is_password_hash(stored):
+    return stored.startswith(HASH_ALGORITHM + "$")
+
+@metrics.timed("auth.verify_password")
+def verify_password(password, stored):
+    # Also accepts the plaintext passwords older versions stored
+    if not is_password_hash(stored):
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        candidate = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), base64.b64decode(salt), int(iterations))
+        return hmac.compare_digest(candidate, base64.b64decode(digest))
+    except ValueError:
+        # Not one of our hashes, e.g. a plaintext password that happens to
+        # start with the algorithm name; nothing can match it
+        return False
+
+def needs_rehash(stored, iterations=None):
+    return not is_password_hash(stored) or int(stored.split("$")[1]) != (iterations or password_iterations())
+
+class TokenBucket:
+    # Holds up to capacity tokens, refilled at rate tokens per second
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait(self):
+        # Seconds until a token is available, 0 if one is available now
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def give_back(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+class LoginRateLimiter:
+    # A shared bucket keeps a burst of attempts from tying up the CPU and
+    # database; per-email buckets slow down guessing one account's password.
+    # An attempt takes a token from both or, when either is empty, from
+    # neither. A successful login gives the per-email token back, so only
+    # failures count against an account. Only the most recently used
+    # max_keys addresses keep their own bucket.
+    def __init__(self, rate=5.0, burst=20, per_key_rate=0.2, per_key_burst=5, max_keys=10000):
+        self.lock = threading.Lock()
+        self.shared = TokenBucket(rate, burst)
+        self.per_key_rate = per_key_rate
+        self.per_key_burst = per_key_burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+
+    def acquire(self, key):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.per_key_rate, self.per_key_burst)
+                while len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            self.buckets.move_to_end(key)
+            wait = max(bucket.wait(), self.shared.wait())
+            if not wait:
+                bucket.take()
+                self.shared.take()
+        if wait:
+            metrics.count("auth.rate_limited")
+            raise RateLimitedError(wait)
+
+    def release(self, key):
+        # The attempt for key succeeded
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.give_back()
+
+class AuthService:
+    def __init__(self, db, verified_seconds=900, limiter=None, iterations=None):
+        self.db = db
+        self.verified_seconds = verified_seconds
+        self.limiter = limiter or LoginRateLimiter()
+        self.iterations = iterations or password_iterations()
+        self.lock = threading.Lock()
+        # email -> (stored hash, keyed digest of the password, expiry), oldest expiry first
+        self.verified = OrderedDict()
+        # Per-process key, so remembered digests are useless outside this process
+        self.digest_key = secrets.token_bytes(32)
+        self.unknown_email_hash = None
+
+    def dummy_hash(self):
+        # Compared against when an email is unknown, so that takes as long as
+        # a wrong password. Made on first use, in the login worker thread,
+        # rather than while the application starts.
+        if self.unknown_email_hash is None:
+            self.unknown_email_hash = hash_password(secrets.token_urlsafe(16), self.iterations)
+        return self.unknown_email_hash
+
+    def keyed_digest(self, password):
+        return hmac.new(self.digest_key, password.encode("utf-8"), hashlib.sha256).digest()
+
+    @metrics.timed("auth.authenticate")
+    def authenticate(self, email, password):
+        # Returns (UserID, RoleName) or raises AuthenticationError / RateLimitedError.
+        # The limiter is keyed by the email exactly as the account is looked up
+        # (Email matching is case-sensitive), so attempts against an unknown
+        # spelling of an address do not use up the real account's bucket.
+        self.limiter.acquire(email)
+        row = self.db.user_credentials(email)
+        if row is None:
+            verify_password(password, self.dummy_hash())
+            raise AuthenticationError("Invalid email or password.")
+        user_id, stored, role_name = row
+
+        now = time.monotonic()
+        with self.lock:
+            remembered = self.verified.get(email)
+        if (remembered is not None and remembered[0] == stored and remembered[2] > now
+                and hmac.compare_digest(remembered[1], self.keyed_digest(password))):
+            metrics.count("auth.verified_cache_hits")
+        else:
+            if not verify_password(password, stored):
+                raise AuthenticationError("Invalid email or password.")
+            if needs_rehash(stored, self.iterations):
+                stored = hash_password(password, self.iterations)
+                self.db.update_password_hash(user_id, stored)
+            with self.lock:
+                self.verified[email] = (stored, self.keyed_digest(password), now + self.verified_seconds)
+                self.verified.move_to_end(email)
+                # Every entry lives equally long, so the expired ones are at the front
+                while self.verified and next(iter(self.verified.values()))[2] <= now:
+                    self.verified.popitem(last=False)
+
+        if role_name is None:
+            raise AuthenticationError("Role not found.")
+        self.limiter.release(email)
+        return user_id, role_name
+
+    def register(self, first_name, last_name, email, password, role_name, gender):
+        # Returns the new UserID; raises ValueError for a taken email or unknown role
+        return self.db.add_user(first_name, last_name, email, hash_password(password, self.iterations),
+                                role_name, gender)
@@ -0,0 +1,117 @@
+# Headless batch scoring of stored interrogation answers, no Qt required.
+#
+#   python zri_batch.py                         # score every unscored answer
+#   python zri_batch.py --workers 16 --rescore  # recompute everything
+#
+# Cases are streamed out of sqlite in chunks and each case is scored as one
+# task on a ScoringService process pool. Results are written back in bulk
+# transactions together with a checkpoint, so an interrupted run picks up
+# after the last committed case when started again with the same --job. A run
+# that finishes clears its checkpoint; the next one starts from the first case
+# and picks up answers added to earlier cases in the meantime.
+import argparse
+import logging
+import sys
+import time
+from collections import deque
+
+from zri_db import Database
+from zri_analysis import ScoringService
+from zri_lexical import LexicalPrefilter
+
+logger = logging.getLogger("zeroreid")
+
+class BatchScorer:
+    def __init__(self, db, service, job, chunk_cases=500, commit_every=200, rescore=False, progress_seconds=10.0):
+        self.db = db
+        self.service = service
+        self.job = job
+        self.chunk_cases = chunk_cases
+        self.commit_every = commit_every
+        self.rescore = rescore
+        self.progress_seconds = progress_seconds
+        self.in_flight = deque()  # (CaseID, answer count, future) in CaseID order
+        self.ready = []  # scored cases waiting for the next commit
+        self.processed = 0  # answers handed to the pool, kept in the checkpoint
+        self.scored_this_run = 0  # answers whose scores were written
+
+    def run(self):
+        last_case_id, self.processed = self.db.batch_checkpoint(self.job)
+        if last_case_id:
+            logger.info("Resuming job %r after case %d (%d answers already processed)",
+                        self.job, last_case_id, self.processed)
+        self.started = self.last_report = time.perf_counter()
+
+        while True:
+            case_ids = self.db.cases_with_answers(last_case_id, self.chunk_cases, unscored_only=not self.rescore)
+            if not case_ids:
+                break
+            for case_id in case_ids:
+                answers = self.db.case_answers(case_id)
+                # Blocks once the pool's in-flight limit is reached
+                future = self.service.submit("score_case_answers", answers)
+                self.in_flight.append((case_id, len(answers), future))
+                self.collect(wait=False)
+            last_case_id = case_ids[-1]
+
+        self.collect(wait=True)
+        self.flush()
+        self.db.reset_batch_checkpoint(self.job)
+        elapsed = time.perf_counter() - self.started
+        logger.info("Scored %d answers in %.1fs (%.0f answers/s)", self.scored_this_run, elapsed,
+                    self.scored_this_run / elapsed if elapsed else 0.0)
+        return self.scored_this_run
+
+    def collect(self, wait):
+        # Results are committed strictly in CaseID order so the checkpoint
+        # never moves past a case that has not been written
+        while self.in_flight and (wait or self.in_flight[0][2].done()):
+            case_id, count, future = self.in_flight.popleft()
+            self.ready.append((case_id, future.result()))
+            self.processed += count
+            if len(self.ready) >= self.commit_every:
+                self.flush()
+        self.report()
+
+    def flush(self):
+        if self.ready:
+            self.scored_this_run += self.db.save_case_scores(self.job, self.ready, self.processed, overwrite=self.rescore)
+            self.ready = []
+
+    def report(self):
+        now = time.perf_counter()
+        if now - self.last_report >= self.progress_seconds:
+            elapsed = now - self.started
+            logger.info("%d answers scored this run, %.0f answers/s", self.scored_this_run, self.scored_this_run / elapsed)
+            self.last_report = now
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score stored interrogation answers in bulk")
+    parser.add_argument("--db", default="witness_submission_system.db")
+    parser.add_argument("--workers", type=int, default=None, help="scoring processes (default: one per core)")
+    parser.add_argument("--job", default="score-answers", help="checkpoint name; reuse it to resume")
+    parser.add_argument("--chunk-cases", type=int, default=500, help="cases read from sqlite per query")
+    parser.add_argument("--commit-every", type=int, default=200, help="cases written per transaction")
+    parser.add_argument("--rescore", action="store_true", help="recompute answers that already have scores")
+    parser.add_argument("--restart", action="store_true", help="discard the job's checkpoint first")
+    parser.add_argument("--cache", action="store_true", help="use the statement cache in the database")
+    parser.add_argument("--prefilter", metavar="SETTING",
+                        help='lexical pre-filter: "on" for near-duplicates, or "duplicate,unrelated,score" with '
+                             'Jaccard thresholds and a calibrated unrelated-pair score, e.g. 0.85,0.05,0.71')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    db = Database(args.db)
+    if args.restart:
+        db.reset_batch_checkpoint(args.job)
+    service = ScoringService(workers=args.workers, cache_file=args.db if args.cache else None,
+                             prefilter=LexicalPrefilter.from_setting(args.prefilter))
+    scorer = BatchScorer(db, service, args.job, args.chunk_cases, args.commit_every, args.rescore)
+    try:
+        scorer.run()
+    except KeyboardInterrupt:
+        logger.warning("Interrupted; progress is saved up to case checkpoint %d", db.batch_checkpoint(args.job)[0])
+        sys.exit(130)
+    finally:
+        service.shutdown(wait=False)
+        db.close_connection()
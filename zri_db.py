@@ -0,0 +1,956 @@
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+from zri_metrics import metrics, InstrumentedConnection
+
+logger = logging.getLogger("zeroreid")
+
+# Tables that link a user to a case in a given role
+ROLE_TABLES = ("Witness", "Suspect", "LawEnforcer")
+
+# The only tables a RoleName may be turned into; anything else is rejected
+# before it gets near an SQL string
+ROLE_TABLE_NAMES = {"Admin": "Admin", "Witness": "Witness", "Suspect": "Suspect", "Law Enforcer": "LawEnforcer"}
+
+# Keep IN (...) lists well below SQLITE_MAX_VARIABLE_NUMBER
+MAX_VARIABLES = 500
+
+# SQL and Python spellings of the normalized "first last" lookup key. SQLite's
+# lower() only folds ASCII, so the Python side must do the same.
+FULL_NAME_KEY_SQL = "lower(FirstName || ' ' || LastName)"
+
+def full_name_key(name):
+    name = " ".join(name.split())
+    return "".join(c.lower() if c.isascii() else c for c in name)
+
+class UnknownParticipantsError(ValueError):
+    # Raised when case participants do not match any registered user
+    def __init__(self, names):
+        self.names = sorted(names)
+        super().__init__("Not found in database: " + ", ".join(self.names))
+
+class ReferenceData:
+    # Roles and case-progress states, which almost never change, read once
+    # and shared by every window. Anything that edits them calls
+    # invalidate(); the next read loads them again.
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.role_ids = {}
+        self.role_names_by_id = {}
+        self.states = []
+
+    def load(self):
+        with self.db.read() as cur:
+            roles = cur.execute("SELECT RoleID, RoleName FROM Role ORDER BY RoleID").fetchall()
+            states = [row[0] for row in cur.execute("SELECT Progress FROM ProgressState ORDER BY Progress")]
+        with self.lock:
+            self.role_ids = {name: role_id for role_id, name in roles}
+            self.role_names_by_id = {role_id: name for role_id, name in roles}
+            self.states = states
+            self.loaded = True
+        metrics.count("reference.loads")
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded = False
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def role_names(self):
+        self.ensure_loaded()
+        return list(self.role_ids)
+
+    def role_id(self, role_name):
+        self.ensure_loaded()
+        return self.role_ids.get(role_name)
+
+    def role_name(self, role_id):
+        self.ensure_loaded()
+        return self.role_names_by_id.get(role_id)
+
+    def role_table(self, role_name):
+        # Member table for a role, or ValueError for a role without one
+        self.ensure_loaded()
+        table = ROLE_TABLE_NAMES.get(role_name)
+        if table is None or role_name not in self.role_ids:
+            raise ValueError(f"Unknown role: {role_name}")
+        return table
+
+    def progress_states(self):
+        self.ensure_loaded()
+        return list(self.states)
+
+class Database:
+    # Hands out one sqlite connection per thread, all in WAL mode so readers
+    # never block the writer. self.conn / self.cur resolve to the calling
+    # thread's connection, so existing window code keeps working unchanged.
+    PRAGMAS = (
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),  # durable across app crashes; WAL makes FULL unnecessary
+        ("cache_size", -32000),  # ~32 MB page cache per connection
+        ("mmap_size", 268435456),  # 256 MB memory-mapped reads
+        ("temp_store", "MEMORY"),
+    )
+
+    # Schema history. Each entry runs once, in order, inside a transaction.
+    # Append new entries; never edit one that has shipped.
+    MIGRATIONS = (
+        (1, "base tables", "create_tables"),
+        (2, "Gender column on every role table", "add_gender_columns"),
+        (3, "lookup indexes", "create_lookup_indexes"),
+        (4, "full-name index", "create_full_name_index"),
+        (5, "case listing sort index", "create_case_listing_index"),
+        (6, "interrogation answers", "create_answer_tables"),
+        (7, "batch job checkpoints", "create_batch_checkpoints"),
+        (8, "materialized case credibility summaries", "create_case_summary"),
+        (9, "archived cases", "create_archived_cases"),
+        (10, "change log for the live case feed", "create_change_log"),
+        (11, "one Role row per role name", "dedupe_roles"),
+        (12, "progress state lookup table", "create_progress_states"),
+        (13, "change log retention and progress state changes", "bound_change_log"),
+        (14, "statement analysis cache", "create_statement_cache"),
+    )
+
+    # Answers scoring below this consistency count as a disagreement in
+    # CaseSummary. Baked into the triggers; changing it needs a migration that
+    # recreates them and calls rebuild_unarchived_case_summary().
+    DISAGREEMENT_THRESHOLD = 0.6
+
+    # ChangeLog rows kept behind the newest one, for change feeds that have
+    # not read them yet. Baked into a trigger like the threshold above.
+    CHANGE_LOG_RETAIN = 10000
+
+    def __init__(self, db_file, timeout=5.0, archive=None):
+        self.db_file = db_file
+        self.timeout = timeout
+        # zri_archive.SegmentStore holding the answers of archived cases, if any
+        self.archive = archive
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.migrate()
+        self.reference = ReferenceData(self)
+
+    def connect(self):
+        # check_same_thread is off only so close_connection() can close every
+        # thread's connection at shutdown; each one is still used by one thread
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout, check_same_thread=False,
+                               factory=InstrumentedConnection)
+        for name, value in self.PRAGMAS:
+            conn.execute(f"PRAGMA {name} = {value}")
+        with self.connections_lock:
+            self.connections.append(conn)
+        return conn
+
+    @property
+    def conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            self.local.cur = conn.cursor()
+        return conn
+
+    @property
+    def cur(self):
+        self.conn
+        return self.local.cur
+
+    def close_thread(self):
+        # Closes the calling thread's connection; worker threads call this when
+        # they finish so their connection and WAL file handles do not outlive them
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            return
+        with self.connections_lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+        self.local.conn = self.local.cur = None
+        conn.close()
+
+    def begin(self, statement):
+        # transaction() and read() do not nest: committing the outer caller's
+        # transaction here would split what it meant to be atomic
+        conn = self.conn
+        if conn.in_transaction:
+            raise sqlite3.ProgrammingError("A transaction is already open on this connection")
+        conn.execute(statement)
+        return conn
+
+    @contextmanager
+    def transaction(self, immediate=True):
+        # Commit on success, roll back on any error. BEGIN IMMEDIATE takes the
+        # write lock up front so two writers cannot deadlock upgrading from read.
+        # Time spent here is time spent waiting for another writer
+        with metrics.span("db.lock_wait"):
+            conn = self.begin("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    @contextmanager
+    def read(self):
+        # Consistent snapshot for multi-statement reads; never blocks writers under WAL
+        conn = self.begin("BEGIN")
+        try:
+            yield conn.cursor()
+        finally:
+            conn.rollback()
+
+    def schema_version(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self, target=None):
+        # Apply every pending migration in order, each in its own transaction.
+        # PRAGMA user_version records the last one applied.
+        current = self.schema_version()
+        for version, description, method in self.MIGRATIONS:
+            if version <= current or (target is not None and version > target):
+                continue
+            with self.transaction() as cur:
+                getattr(self, method)(cur)
+                cur.execute(f"PRAGMA user_version = {version}")
+            logger.info("Applied schema migration %d: %s", version, description)
+            current = version
+        return current
+
+    def column_names(self, cur, table):
+        return {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+
+    def create_tables(self, cur):
+        cur.execute('''CREATE TABLE IF NOT EXISTS Role (
+                                RoleID INTEGER PRIMARY KEY AUTOINCREMENT,
+                                RoleName TEXT NOT NULL
+                            )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS User (
+                                UserID INTEGER PRIMARY KEY AUTOINCREMENT,
+                                FirstName TEXT NOT NULL,
+                                LastName TEXT NOT NULL,
+                                Email TEXT UNIQUE NOT NULL,
+                                Password TEXT NOT NULL,
+                                RoleID INTEGER,
+                                FOREIGN KEY (RoleID) REFERENCES Role(RoleID)
+                            )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS Cases (
+                                CaseID INTEGER PRIMARY KEY AUTOINCREMENT,
+                                CaseDescription TEXT
+                            )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS Witness (
+                                WitnessID INTEGER PRIMARY KEY AUTOINCREMENT,
+                                UserID INTEGER,
+                                CaseID INTEGER,
+                                Gender TEXT,
+                                FOREIGN KEY (UserID) REFERENCES User(UserID),
+                                FOREIGN KEY (CaseID) REFERENCES Cases(CaseID)
+                            )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS Suspect (
+                                SuspectID INTEGER PRIMARY KEY AUTOINCREMENT,
+                                UserID INTEGER,
+                                CaseID INTEGER,
+                                Gender TEXT,
+                                FOREIGN KEY (UserID) REFERENCES User(UserID),
+                                FOREIGN KEY (CaseID) REFERENCES Cases(CaseID)
+                            )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS LawEnforcer (
+                                EnforcerID INTEGER PRIMARY KEY AUTOINCREMENT,
+                                UserID INTEGER,
+                                CaseID INTEGER,
+                                Gender TEXT,
+                                FOREIGN KEY (UserID) REFERENCES User(UserID),
+                                FOREIGN KEY (CaseID) REFERENCES Cases(CaseID)
+                            )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS Admin (
+                                AdminID INTEGER PRIMARY KEY AUTOINCREMENT,
+                                UserID INTEGER,
+                                FOREIGN KEY (UserID) REFERENCES User(UserID)
+                            )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS CaseProgress (
+                                ProgressID INTEGER PRIMARY KEY AUTOINCREMENT,
+                                CaseID INTEGER,
+                                Progress TEXT,
+                                FOREIGN KEY (CaseID) REFERENCES Cases(CaseID)
+                            )''')
+
+    def add_gender_columns(self, cur):
+        # Older builds created Witness and LawEnforcer without Gender in the same file
+        for table in ROLE_TABLES:
+            if "Gender" not in self.column_names(cur, table):
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN Gender TEXT")
+
+    def create_lookup_indexes(self, cur):
+        # Covering indexes for the role-table lookups the app runs:
+        # a user's cases (UserID -> CaseID) and a case's participants (CaseID -> UserID)
+        for table in ROLE_TABLES:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table.lower()}_user_case ON {table} (UserID, CaseID)")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table.lower()}_case_user ON {table} (CaseID, UserID)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_admin_user ON Admin (UserID)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_caseprogress_case ON CaseProgress (CaseID)")
+        cur.execute("ANALYZE")
+
+    def create_full_name_index(self, cur):
+        # Expression index so exact name lookups no longer scan User
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_user_full_name ON User ({FULL_NAME_KEY_SQL})")
+
+    def create_case_listing_index(self, cur):
+        # Lets pending_cases_page() walk cases in description order without sorting
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_cases_description ON Cases (COALESCE(CaseDescription, ''), CaseID)")
+
+    def create_answer_tables(self, cur):
+        cur.execute('''CREATE TABLE IF NOT EXISTS Answer (
+                            AnswerID INTEGER PRIMARY KEY AUTOINCREMENT,
+                            CaseID INTEGER NOT NULL,
+                            UserID INTEGER NOT NULL,
+                            QuestionIndex INTEGER NOT NULL,
+                            Question TEXT NOT NULL,
+                            AnswerText TEXT NOT NULL,
+                            SubmittedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                            EmotionScore REAL,
+                            Obedient TEXT,
+                            SelfConsistency REAL,
+                            CaseConsistency REAL,
+                            ConfidenceScore REAL,
+                            FOREIGN KEY (UserID) REFERENCES User(UserID),
+                            FOREIGN KEY (CaseID) REFERENCES Cases(CaseID)
+                        )''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_answer_case_user ON Answer (CaseID, UserID, AnswerID)")
+
+    def create_batch_checkpoints(self, cur):
+        cur.execute('''CREATE TABLE IF NOT EXISTS BatchCheckpoint (
+                            JobName TEXT PRIMARY KEY,
+                            LastCaseID INTEGER NOT NULL DEFAULT 0,
+                            Processed INTEGER NOT NULL DEFAULT 0,
+                            UpdatedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+                        )''')
+
+    def case_summary_upsert(self, row, case_id, user_id):
+        # Recomputes one CaseSummary row from the case's scored answers.
+        # row is the trigger's OLD or NEW; user_id is a column of it or 0.
+        who = f"AND UserID = {row}.{user_id}" if user_id != "0" else ""
+        user = f"{row}.{user_id}" if user_id != "0" else "0"
+        threshold = self.DISAGREEMENT_THRESHOLD
+        return f'''INSERT INTO CaseSummary (CaseID, UserID, AnswerCount, ConfidenceSum, ConfidenceSquareSum,
+                                          ConfidenceMin, ConfidenceMax, SelfDisagreements, CaseDisagreements)
+                   SELECT {row}.{case_id}, {user}, COUNT(*), TOTAL(ConfidenceScore),
+                          TOTAL(ConfidenceScore * ConfidenceScore), MIN(ConfidenceScore), MAX(ConfidenceScore),
+                          TOTAL(SelfConsistency < {threshold}), TOTAL(CaseConsistency < {threshold})
+                   FROM Answer WHERE CaseID = {row}.{case_id} {who} AND ConfidenceScore IS NOT NULL
+                   ON CONFLICT (CaseID, UserID) DO UPDATE SET
+                       AnswerCount = excluded.AnswerCount, ConfidenceSum = excluded.ConfidenceSum,
+                       ConfidenceSquareSum = excluded.ConfidenceSquareSum, ConfidenceMin = excluded.ConfidenceMin,
+                       ConfidenceMax = excluded.ConfidenceMax, SelfDisagreements = excluded.SelfDisagreements,
+                       CaseDisagreements = excluded.CaseDisagreements;'''
+
+    def create_case_summary(self, cur):
+        # Credibility aggregates per witness (UserID) and per case (UserID 0),
+        # kept current by triggers so a case overview is a single-row read.
+        # Variance comes from the sum of squares.
+        cur.execute('''CREATE TABLE IF NOT EXISTS CaseSummary (
+                            CaseID INTEGER NOT NULL,
+                            UserID INTEGER NOT NULL,
+                            AnswerCount INTEGER NOT NULL DEFAULT 0,
+                            ConfidenceSum REAL NOT NULL DEFAULT 0,
+                            ConfidenceSquareSum REAL NOT NULL DEFAULT 0,
+                            ConfidenceMin REAL,
+                            ConfidenceMax REAL,
+                            SelfDisagreements INTEGER NOT NULL DEFAULT 0,
+                            CaseDisagreements INTEGER NOT NULL DEFAULT 0,
+                            Participants INTEGER NOT NULL DEFAULT 0,
+                            PRIMARY KEY (CaseID, UserID)
+                        )''')
+        threshold = self.DISAGREEMENT_THRESHOLD
+        # A newly scored answer is folded in without rereading the case
+        increments = " ".join(f'''INSERT INTO CaseSummary (CaseID, UserID, AnswerCount, ConfidenceSum, ConfidenceSquareSum,
+                                              ConfidenceMin, ConfidenceMax, SelfDisagreements, CaseDisagreements)
+                       VALUES (NEW.CaseID, {user}, 1, NEW.ConfidenceScore, NEW.ConfidenceScore * NEW.ConfidenceScore,
+                               NEW.ConfidenceScore, NEW.ConfidenceScore,
+                               COALESCE(NEW.SelfConsistency < {threshold}, 0), COALESCE(NEW.CaseConsistency < {threshold}, 0))
+                       ON CONFLICT (CaseID, UserID) DO UPDATE SET
+                           AnswerCount = AnswerCount + 1,
+                           ConfidenceSum = ConfidenceSum + excluded.ConfidenceSum,
+                           ConfidenceSquareSum = ConfidenceSquareSum + excluded.ConfidenceSquareSum,
+                           ConfidenceMin = MIN(COALESCE(ConfidenceMin, excluded.ConfidenceMin), excluded.ConfidenceMin),
+                           ConfidenceMax = MAX(COALESCE(ConfidenceMax, excluded.ConfidenceMax), excluded.ConfidenceMax),
+                           SelfDisagreements = SelfDisagreements + excluded.SelfDisagreements,
+                           CaseDisagreements = CaseDisagreements + excluded.CaseDisagreements;'''
+                             for user in ("NEW.UserID", "0"))
+        cur.execute(f'''CREATE TRIGGER IF NOT EXISTS case_summary_answer_scored
+                       AFTER UPDATE OF ConfidenceScore ON Answer
+                       WHEN OLD.ConfidenceScore IS NULL AND NEW.ConfidenceScore IS NOT NULL
+                       BEGIN {increments} END''')
+        # Rescored or deleted answers can move the minimum and maximum, so
+        # the witness's and case's rows are recomputed from their answers
+        cur.execute(f'''CREATE TRIGGER IF NOT EXISTS case_summary_answer_rescored
+                       AFTER UPDATE OF ConfidenceScore, SelfConsistency, CaseConsistency ON Answer
+                       WHEN OLD.ConfidenceScore IS NOT NULL
+                       BEGIN {self.case_summary_upsert("NEW", "CaseID", "UserID")}
+                             {self.case_summary_upsert("NEW", "CaseID", "0")} END''')
+        cur.execute(f'''CREATE TRIGGER IF NOT EXISTS case_summary_answer_deleted
+                       AFTER DELETE ON Answer
+                       WHEN OLD.ConfidenceScore IS NOT NULL
+                       BEGIN {self.case_summary_upsert("OLD", "CaseID", "UserID")}
+                             {self.case_summary_upsert("OLD", "CaseID", "0")} END''')
+
+        participants = " + ".join(f"(SELECT COUNT(*) FROM {table} WHERE CaseID = {{row}}.CaseID)" for table in ROLE_TABLES)
+        for table in ROLE_TABLES:
+            for event, row in (("INSERT", "NEW"), ("DELETE", "OLD")):
+                cur.execute(f'''CREATE TRIGGER IF NOT EXISTS case_summary_{table.lower()}_{event.lower()}
+                               AFTER {event} ON {table}
+                               WHEN {row}.CaseID IS NOT NULL
+                               BEGIN
+                                   INSERT INTO CaseSummary (CaseID, UserID, Participants)
+                                   VALUES ({row}.CaseID, 0, {participants.format(row=row)})
+                                   ON CONFLICT (CaseID, UserID) DO UPDATE SET Participants = excluded.Participants;
+                               END''')
+        self.rebuild_case_summary(cur)
+
+    def rebuild_case_summary(self, cur):
+        # Recomputes every CaseSummary row from Answer and the role tables
+        threshold = self.DISAGREEMENT_THRESHOLD
+        cur.execute("DELETE FROM CaseSummary")
+        aggregates = f'''COUNT(*), TOTAL(ConfidenceScore), TOTAL(ConfidenceScore * ConfidenceScore),
+                         MIN(ConfidenceScore), MAX(ConfidenceScore),
+                         TOTAL(SelfConsistency < {threshold}), TOTAL(CaseConsistency < {threshold})'''
+        columns = '''CaseID, UserID, AnswerCount, ConfidenceSum, ConfidenceSquareSum, ConfidenceMin, ConfidenceMax,
+                     SelfDisagreements, CaseDisagreements'''
+        cur.execute(f'''INSERT INTO CaseSummary ({columns})
+                       SELECT CaseID, UserID, {aggregates} FROM Answer
+                       WHERE ConfidenceScore IS NOT NULL GROUP BY CaseID, UserID''')
+        cur.execute(f'''INSERT INTO CaseSummary ({columns})
+                       SELECT CaseID, 0, {aggregates} FROM Answer
+                       WHERE ConfidenceScore IS NOT NULL GROUP BY CaseID''')
+        members = " UNION ALL ".join(f"SELECT CaseID FROM {table} WHERE CaseID IS NOT NULL" for table in ROLE_TABLES)
+        cur.execute(f'''INSERT INTO CaseSummary (CaseID, UserID, Participants)
+                       SELECT CaseID, 0, COUNT(*) FROM ({members}) GROUP BY CaseID
+                       ON CONFLICT (CaseID, UserID) DO UPDATE SET Participants = excluded.Participants''')
+
+    def rebuild_unarchived_case_summary(self, cur):
+        # rebuild_case_summary() for migrations after archiving existed.
+        # Archived cases have no Answer rows left to recompute from, so their
+        # rows are set aside and put back unchanged.
+        cur.execute('''CREATE TEMP TABLE ArchivedCaseSummary AS
+                       SELECT * FROM CaseSummary WHERE CaseID IN (SELECT CaseID FROM ArchivedCase)''')
+        self.rebuild_case_summary(cur)
+        cur.execute("INSERT OR REPLACE INTO CaseSummary SELECT * FROM ArchivedCaseSummary")
+        cur.execute("DROP TABLE temp.ArchivedCaseSummary")
+
+    def create_archived_cases(self, cur):
+        # Cases whose answers were moved to the statement archive. Deleting
+        # their Answer rows must leave CaseSummary alone, so the delete
+        # trigger skips them.
+        cur.execute('''CREATE TABLE IF NOT EXISTS ArchivedCase (
+                            CaseID INTEGER PRIMARY KEY,
+                            AnswerCount INTEGER NOT NULL,
+                            ArchivedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+                        )''')
+        cur.execute("DROP TRIGGER IF EXISTS case_summary_answer_deleted")
+        cur.execute(f'''CREATE TRIGGER case_summary_answer_deleted
+                       AFTER DELETE ON Answer
+                       WHEN OLD.ConfidenceScore IS NOT NULL
+                            AND NOT EXISTS (SELECT 1 FROM ArchivedCase WHERE CaseID = OLD.CaseID)
+                       BEGIN {self.case_summary_upsert("OLD", "CaseID", "UserID")}
+                             {self.case_summary_upsert("OLD", "CaseID", "0")} END''')
+
+    # (table, event, topic, CaseID, UserID) for every ChangeLog trigger; see zri_feed
+    CHANGE_TRIGGERS = (
+        [("Cases", event, "case", f"{row}.CaseID", "NULL")
+         for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD"))]
+        + [("CaseProgress", event, "progress", f"{row}.CaseID", "NULL")
+           for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD"))]
+        + [(table, event, "participant", f"{row}.CaseID", f"{row}.UserID")
+           for table in ROLE_TABLES for event, row in (("INSERT", "NEW"), ("DELETE", "OLD"))]
+        + [("Answer", "INSERT", "answer", "NEW.CaseID", "NEW.UserID"),
+           ("Answer", "DELETE", "answer", "OLD.CaseID", "OLD.UserID"),
+           ("Answer", "UPDATE OF ConfidenceScore", "score", "NEW.CaseID", "NEW.UserID")]
+        + [("Role", event, "role", "NULL", "NULL") for event in ("INSERT", "UPDATE", "DELETE")]
+    )
+
+    def create_change_log(self, cur):
+        # Append-only record of changes, read by zri_feed.ChangeFeed. Seq only
+        # grows and, since writers are serialized, rows commit in Seq order.
+        cur.execute('''CREATE TABLE IF NOT EXISTS ChangeLog (
+                            Seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                            Topic TEXT NOT NULL,
+                            CaseID INTEGER,
+                            UserID INTEGER
+                        )''')
+        for table, event, topic, case_id, user_id in self.CHANGE_TRIGGERS:
+            name = f"changelog_{table.lower()}_{event.split()[0].lower()}"
+            cur.execute(f'''CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table} BEGIN
+                               INSERT INTO ChangeLog (Topic, CaseID, UserID) VALUES ('{topic}', {case_id}, {user_id});
+                           END''')
+        # Role table rows moved between cases or users
+        for table in ROLE_TABLES:
+            cur.execute(f'''CREATE TRIGGER IF NOT EXISTS changelog_{table.lower()}_update
+                           AFTER UPDATE OF UserID, CaseID ON {table} BEGIN
+                               INSERT INTO ChangeLog (Topic, CaseID, UserID) VALUES ('participant', OLD.CaseID, OLD.UserID);
+                               INSERT INTO ChangeLog (Topic, CaseID, UserID) VALUES ('participant', NEW.CaseID, NEW.UserID);
+                           END''')
+
+    def dedupe_roles(self, cur):
+        # Older versions inserted the four roles on every start. Users move to
+        # the first row of their role's name and the other rows are dropped.
+        # Repeats are ignored from now on; a UNIQUE index instead would make
+        # those versions fail at start-up.
+        first_role = "(SELECT MIN(r.RoleID) FROM Role r WHERE r.RoleName = Role.RoleName)"
+        cur.execute(f'''UPDATE User SET RoleID = (SELECT {first_role} FROM Role WHERE Role.RoleID = User.RoleID)
+                       WHERE RoleID IN (SELECT RoleID FROM Role WHERE RoleID > {first_role})''')
+        cur.execute(f"DELETE FROM Role WHERE RoleID > {first_role}")
+        cur.execute('''CREATE TRIGGER IF NOT EXISTS role_name_unique BEFORE INSERT ON Role
+                       WHEN EXISTS (SELECT 1 FROM Role WHERE RoleName = NEW.RoleName) BEGIN
+                           SELECT RAISE(IGNORE);
+                       END''')
+
+    def create_progress_states(self, cur):
+        # Every progress value ever recorded, kept by triggers, so ReferenceData
+        # no longer scans CaseProgress for the distinct values
+        cur.execute("CREATE TABLE IF NOT EXISTS ProgressState (Progress TEXT PRIMARY KEY) WITHOUT ROWID")
+        cur.execute('''INSERT OR IGNORE INTO ProgressState (Progress)
+                       SELECT DISTINCT Progress FROM CaseProgress WHERE Progress IS NOT NULL''')
+        for event in ("INSERT", "UPDATE OF Progress"):
+            cur.execute(f'''CREATE TRIGGER IF NOT EXISTS progress_state_{event.split()[0].lower()}
+                           AFTER {event} ON CaseProgress WHEN NEW.Progress IS NOT NULL BEGIN
+                               INSERT OR IGNORE INTO ProgressState (Progress) VALUES (NEW.Progress);
+                           END''')
+
+    def bound_change_log(self, cur):
+        # Every writer prunes ChangeLog as it appends, so it stays bounded
+        # without a feed running, e.g. under zri_batch or zri_import: each
+        # 1000th row drops everything CHANGE_LOG_RETAIN rows behind it.
+        cur.execute(f'''CREATE TRIGGER IF NOT EXISTS changelog_retention AFTER INSERT ON ChangeLog
+                       WHEN NEW.Seq % 1000 = 0 BEGIN
+                           DELETE FROM ChangeLog WHERE Seq <= NEW.Seq - {self.CHANGE_LOG_RETAIN};
+                       END''')
+        cur.execute(f"DELETE FROM ChangeLog WHERE Seq <= (SELECT MAX(Seq) FROM ChangeLog) - {self.CHANGE_LOG_RETAIN}")
+        # Progress values recorded for the first time change the reference
+        # data; other progress changes do not
+        cur.execute('''CREATE TRIGGER IF NOT EXISTS changelog_progressstate_insert AFTER INSERT ON ProgressState BEGIN
+                           INSERT INTO ChangeLog (Topic, CaseID, UserID) VALUES ('progress_state', NULL, NULL);
+                       END''')
+
+    def create_statement_cache(self, cur):
+        # Per-statement results for zri_analysis.StatementCache. Scope is the
+        # NLP mode that wrote the row; caches created before it lack the column.
+        cur.execute('''CREATE TABLE IF NOT EXISTS StatementCache (
+                            TextHash TEXT PRIMARY KEY,
+                            ModelVersion TEXT NOT NULL,
+                            Vector BLOB,
+                            TokenKey TEXT,
+                            Polarity TEXT,
+                            Scope TEXT
+                        )''')
+        if "Scope" not in self.column_names(cur, "StatementCache"):
+            cur.execute("ALTER TABLE StatementCache ADD COLUMN Scope TEXT")
+
+    def resolve_names(self, cur, names):
+        # Map "First Last" names to UserIDs in one indexed query per 500 names.
+        # Matching ignores case and extra whitespace; ambiguous names resolve
+        # to the oldest user. Unknown names are absent from the result.
+        keys = {}
+        for name in names:
+            keys.setdefault(full_name_key(name), []).append(name)
+        key_list = list(keys)
+        resolved = {}
+        for start in range(0, len(key_list), MAX_VARIABLES):
+            chunk = key_list[start:start + MAX_VARIABLES]
+            placeholders = ", ".join("?" * len(chunk))
+            cur.execute(f'''SELECT {FULL_NAME_KEY_SQL} AS NameKey, MIN(UserID) FROM User
+                            WHERE NameKey IN ({placeholders}) GROUP BY NameKey''', chunk)
+            for key, user_id in cur.fetchall():
+                for name in keys[key]:
+                    resolved[name] = user_id
+        return resolved
+
+    def user_credentials(self, email):
+        # (UserID, stored password, RoleName) in one lookup on the Email index, or None
+        return self.conn.execute('''SELECT u.UserID, u.Password, r.RoleName
+                                    FROM User u LEFT JOIN Role r ON r.RoleID = u.RoleID
+                                    WHERE u.Email = ?''', (email,)).fetchone()
+
+    def update_password_hash(self, user_id, password_hash):
+        with self.transaction() as cur:
+            cur.execute("UPDATE User SET Password = ? WHERE UserID = ?", (password_hash, user_id))
+
+    def add_user(self, first_name, last_name, email, password_hash, role_name, gender):
+        # Creates the user and their role table row in one transaction. The
+        # UNIQUE constraint on Email is the existence check. The role is
+        # resolved first: reloading invalidated ReferenceData opens its own
+        # read, which cannot happen inside the transaction.
+        try:
+            table_name = self.reference.role_table(role_name)
+        except ValueError:
+            raise ValueError("Role not found.")
+        role_id = self.reference.role_id(role_name)
+        with self.transaction() as cur:
+            try:
+                cur.execute("INSERT INTO User (FirstName, LastName, Email, Password, RoleID) VALUES (?, ?, ?, ?, ?)",
+                            (first_name, last_name, email, password_hash, role_id))
+            except sqlite3.IntegrityError:
+                raise ValueError("Email already exists.")
+            user_id = cur.lastrowid
+            if table_name in ROLE_TABLES:
+                cur.execute(f"INSERT INTO {table_name} (UserID, Gender) VALUES (?, ?)", (user_id, gender))
+            else:
+                # Admin has no Gender column
+                cur.execute(f"INSERT INTO {table_name} (UserID) VALUES (?)", (user_id,))
+        return user_id
+
+    def add_role(self, role_name):
+        if role_name not in ROLE_TABLE_NAMES:
+            raise ValueError(f"Roles must be one of: {', '.join(ROLE_TABLE_NAMES)}")
+        with self.transaction() as cur:
+            cur.execute("INSERT INTO Role (RoleName) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM Role WHERE RoleName = ?)",
+                        (role_name, role_name))
+        self.reference.invalidate()
+
+    def set_case_progress(self, case_id, progress):
+        with self.transaction() as cur:
+            cur.execute("INSERT INTO CaseProgress (CaseID, Progress) SELECT ?, ? WHERE EXISTS (SELECT 1 FROM Cases WHERE CaseID = ?)",
+                        (case_id, progress, case_id))
+            if cur.rowcount == 0:
+                raise ValueError(f"No case with ID {case_id}.")
+        if progress not in self.reference.progress_states():
+            self.reference.invalidate()
+
+    def add_case(self, description, participants):
+        # participants maps a role table name to a list of "First Last" names.
+        # The case and every participant row are written atomically.
+        case_ids, unknown = self.add_cases([(description, participants)])
+        return case_ids[0]
+
+    def add_cases(self, cases, skip_unknown=False):
+        # Bulk ingestion: cases is a list of (description, participants) pairs.
+        # All names are resolved up front and everything is inserted in one
+        # transaction. Unknown names abort the whole batch unless skip_unknown
+        # is set, in which case only the affected cases are left out.
+        # Returns (case_ids, unknown): case_ids[i] is None for a skipped case and
+        # unknown maps the case's index to its missing names.
+        cases = list(cases)
+        for description, participants in cases:
+            for role in participants:
+                if role not in ROLE_TABLES:
+                    raise ValueError(f"Unknown role table: {role}")
+
+        with self.transaction() as cur:
+            all_names = [name for _, participants in cases for names in participants.values() for name in names]
+            user_ids = self.resolve_names(cur, all_names)
+
+            unknown = {}
+            for index, (_, participants) in enumerate(cases):
+                missing = {name for names in participants.values() for name in names if name not in user_ids}
+                if missing:
+                    unknown[index] = sorted(missing)
+            if unknown and not skip_unknown:
+                raise UnknownParticipantsError({name for names in unknown.values() for name in names})
+
+            case_ids = []
+            role_rows = {role: [] for role in ROLE_TABLES}
+            for index, (description, participants) in enumerate(cases):
+                if index in unknown:
+                    case_ids.append(None)
+                    continue
+                cur.execute("INSERT INTO Cases (CaseDescription) VALUES (?)", (description,))
+                case_id = cur.lastrowid
+                case_ids.append(case_id)
+                for role, names in participants.items():
+                    role_rows[role].extend((user_ids[name], case_id) for name in names)
+
+            for role, rows in role_rows.items():
+                if rows:
+                    cur.executemany(f"INSERT INTO {role} (UserID, CaseID) VALUES (?, ?)", rows)
+        return case_ids, unknown
+
+    # Sort keys pending_cases_page() accepts; each pairs with CaseID for a stable keyset
+    CASE_SORT_KEYS = {
+        "CaseID": "c.CaseID",
+        "CaseDescription": "COALESCE(c.CaseDescription, '')",
+    }
+
+    def case_listing_conditions(self, role_table, user_id, search):
+        # WHERE conditions and parameters for listing cases as alias c
+        if role_table is not None and role_table not in ROLE_TABLES:
+            raise ValueError(f"Unknown role table: {role_table}")
+        conditions = []
+        params = []
+        if role_table is not None:
+            # Semi-join keeps the scan in CaseID order and drops duplicate memberships
+            conditions.append(f"c.CaseID IN (SELECT CaseID FROM {role_table} WHERE UserID = ?)")
+            params.append(user_id)
+        if search:
+            conditions.append("c.CaseDescription LIKE ? ESCAPE '\\'")
+            escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append(f"%{escaped}%")
+        return conditions, params
+
+    def pending_cases_page(self, role_table=None, user_id=None, after=None, limit=200,
+                           sort="CaseID", descending=False, search=None):
+        # One page of cases with their description and latest progress.
+        # role_table/user_id restrict to one participant's cases (None = all
+        # cases, for Admin). Pagination is by keyset: pass the "key" of the
+        # last row already shown as after. Returns (rows, next_key) where
+        # rows are (CaseID, CaseDescription, Progress) and next_key is None
+        # once the listing is exhausted.
+        sort_expr = self.CASE_SORT_KEYS[sort]
+        direction = "DESC" if descending else "ASC"
+        comparison = "<" if descending else ">"
+
+        conditions, params = self.case_listing_conditions(role_table, user_id, search)
+        if after is not None:
+            if sort == "CaseID":
+                conditions.append(f"c.CaseID {comparison} ?")
+                params.append(after[1])
+            else:
+                # Spelled out rather than as a row value, which SQLite cannot
+                # seek with: the leading >= (or <=) is what positions the page
+                # in idx_cases_description instead of scanning up to it
+                conditions.append(f"{sort_expr} {comparison}= ? AND ({sort_expr} {comparison} ? OR c.CaseID {comparison} ?)")
+                params.extend((after[0], after[0], after[1]))
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+        # Latest progress is looked up only for the rows on this page
+        rows = self.conn.execute(f'''SELECT page.CaseID, page.CaseDescription,
+                                         (SELECT Progress FROM CaseProgress p WHERE p.CaseID = page.CaseID
+                                          ORDER BY p.ProgressID DESC LIMIT 1) AS Progress,
+                                         page.SortKey
+                                     FROM (SELECT c.CaseID, c.CaseDescription, {sort_expr} AS SortKey
+                                           FROM Cases c
+                                           {where}
+                                           ORDER BY SortKey {direction}, c.CaseID {direction}
+                                           LIMIT ?) AS page
+                                     ORDER BY page.SortKey {direction}, page.CaseID {direction}''',
+                                 params + [limit]).fetchall()
+        next_key = (rows[-1][3], rows[-1][0]) if len(rows) == limit else None
+        return [row[:3] for row in rows], next_key
+
+    def cases_by_id(self, case_ids, role_table=None, user_id=None, search=None):
+        # (CaseID, CaseDescription, Progress) for those of case_ids that
+        # pending_cases_page() would list with the same filters
+        rows = []
+        case_ids = list(case_ids)
+        conditions, params = self.case_listing_conditions(role_table, user_id, search)
+        for start in range(0, len(case_ids), MAX_VARIABLES):
+            chunk = case_ids[start:start + MAX_VARIABLES]
+            where = " AND ".join(conditions + [f"c.CaseID IN ({', '.join('?' * len(chunk))})"])
+            rows.extend(self.conn.execute(f'''SELECT c.CaseID, c.CaseDescription,
+                                                   (SELECT Progress FROM CaseProgress p WHERE p.CaseID = c.CaseID
+                                                    ORDER BY p.ProgressID DESC LIMIT 1)
+                                               FROM Cases c WHERE {where}''', params + chunk).fetchall())
+        return rows
+
+    def participant_case_ids(self, role_table, user_id):
+        if role_table not in ROLE_TABLES:
+            raise ValueError(f"Unknown role table: {role_table}")
+        return {row[0] for row in self.conn.execute(f"SELECT CaseID FROM {role_table} WHERE UserID = ?", (user_id,))}
+
+    def add_answer(self, case_id, user_id, question_index, question, answer):
+        with self.transaction() as cur:
+            cur.execute('''INSERT INTO Answer (CaseID, UserID, QuestionIndex, Question, AnswerText)
+                           VALUES (?, ?, ?, ?, ?)''', (case_id, user_id, question_index, question, answer))
+            return cur.lastrowid
+
+    def answer_context(self, answer_id):
+        # Texts an answer is scored against: (this witness's earlier answers on
+        # the case, other witnesses' earlier answers on the same case). Only
+        # answers recorded before it count, matching a batch rescore.
+        with self.read() as cur:
+            case_id, user_id = cur.execute("SELECT CaseID, UserID FROM Answer WHERE AnswerID = ?", (answer_id,)).fetchone()
+            earlier = [row[0] for row in cur.execute(
+                "SELECT AnswerText FROM Answer WHERE CaseID = ? AND UserID = ? AND AnswerID < ? ORDER BY AnswerID",
+                (case_id, user_id, answer_id))]
+            others = [row[0] for row in cur.execute(
+                "SELECT AnswerText FROM Answer WHERE CaseID = ? AND UserID != ? AND AnswerID < ? ORDER BY AnswerID",
+                (case_id, user_id, answer_id))]
+        return earlier, others
+
+    def record_answer_scores(self, answer_id, scores):
+        # Store an answer's scores once; the CaseSummary triggers fold them
+        # into the witness's and the case's totals
+        with self.transaction() as cur:
+            cur.execute('''UPDATE Answer SET EmotionScore = ?, Obedient = ?, SelfConsistency = ?,
+                                              CaseConsistency = ?, ConfidenceScore = ?
+                           WHERE AnswerID = ? AND ConfidenceScore IS NULL''',
+                        (scores['emotion_score'], scores['obedient'], scores['self_consistency'],
+                         scores['case_consistency'], scores['confidence_score'], answer_id))
+
+    def witness_score(self, case_id, user_id):
+        # One witness's credibility on a case from their CaseSummary row, or
+        # None before any of their answers is scored
+        row = self.conn.execute(f"SELECT {self.SUMMARY_COLUMNS} FROM CaseSummary WHERE CaseID = ? AND UserID = ?",
+                                (case_id, user_id)).fetchone()
+        return self.summary_from_row(row) if row is not None and row[1] else None
+
+    SUMMARY_COLUMNS = '''UserID, AnswerCount, ConfidenceSum, ConfidenceSquareSum, ConfidenceMin, ConfidenceMax,
+                         SelfDisagreements, CaseDisagreements, Participants'''
+
+    @staticmethod
+    def summary_from_row(row):
+        user_id, count, total, squares, low, high, self_disagreements, case_disagreements, participants = row
+        mean = total / count if count else None
+        return {
+            'user_id': user_id or None,
+            'answers': count,
+            'mean_confidence': mean,
+            # Population variance; clamped because rounding can push it just below zero
+            'confidence_variance': max(squares / count - mean * mean, 0.0) if count else None,
+            'min_confidence': low,
+            'max_confidence': high,
+            'self_disagreements': self_disagreements,
+            'case_disagreements': case_disagreements,
+            'participants': participants if not user_id else None,
+        }
+
+    def case_summary(self, case_id):
+        # Credibility overview for a whole case from its CaseSummary row, or None
+        row = self.conn.execute(f"SELECT {self.SUMMARY_COLUMNS} FROM CaseSummary WHERE CaseID = ? AND UserID = 0",
+                                (case_id,)).fetchone()
+        return self.summary_from_row(row) if row is not None else None
+
+    def witness_summaries(self, case_id):
+        # Per-participant credibility on a case, in UserID order
+        rows = self.conn.execute(f"SELECT {self.SUMMARY_COLUMNS} FROM CaseSummary WHERE CaseID = ? AND UserID > 0 "
+                                 "ORDER BY UserID", (case_id,)).fetchall()
+        return [self.summary_from_row(row) for row in rows]
+
+    def data_version(self):
+        # Changes whenever another connection commits; see zri_feed
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def latest_change_seq(self):
+        return self.conn.execute("SELECT COALESCE(MAX(Seq), 0) FROM ChangeLog").fetchone()[0]
+
+    def changes_after(self, seq, limit):
+        # Next chunk of (Seq, Topic, CaseID, UserID) in Seq order
+        return self.conn.execute("SELECT Seq, Topic, CaseID, UserID FROM ChangeLog WHERE Seq > ? ORDER BY Seq LIMIT ?",
+                                 (seq, limit)).fetchall()
+
+    def batch_checkpoint(self, job):
+        # (last CaseID fully written, answers processed so far) for a batch job
+        row = self.conn.execute("SELECT LastCaseID, Processed FROM BatchCheckpoint WHERE JobName = ?", (job,)).fetchone()
+        return row if row is not None else (0, 0)
+
+    def reset_batch_checkpoint(self, job):
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM BatchCheckpoint WHERE JobName = ?", (job,))
+
+    def cases_with_answers(self, after_case_id, limit, unscored_only=True):
+        # Next chunk of CaseIDs, in order, that have answers (still) to score
+        condition = "AND ConfidenceScore IS NULL" if unscored_only else ""
+        return [row[0] for row in self.conn.execute(
+            f"SELECT DISTINCT CaseID FROM Answer WHERE CaseID > ? {condition} ORDER BY CaseID LIMIT ?",
+            (after_case_id, limit))]
+
+    def case_answers(self, case_id):
+        return self.conn.execute("SELECT AnswerID, UserID, AnswerText FROM Answer WHERE CaseID = ? ORDER BY AnswerID",
+                                 (case_id,)).fetchall()
+
+    def indexable_answers(self, after_answer_id, limit):
+        # Next chunk of (AnswerID, CaseID, role table, AnswerText) in AnswerID
+        # order. The role is the first role table listing the author on the
+        # case, or None.
+        roles = " ".join(f"WHEN EXISTS (SELECT 1 FROM {table} r WHERE r.CaseID = a.CaseID AND r.UserID = a.UserID) "
+                         f"THEN '{table}'" for table in ROLE_TABLES)
+        return self.conn.execute(f'''SELECT a.AnswerID, a.CaseID, CASE {roles} END, a.AnswerText
+                                     FROM Answer a WHERE a.AnswerID > ? ORDER BY a.AnswerID LIMIT ?''',
+                                 (after_answer_id, limit)).fetchall()
+
+    def answer_texts(self, answer_ids):
+        # {AnswerID: AnswerText} for the given answers, archived ones included
+        texts = {}
+        answer_ids = list(answer_ids)
+        for start in range(0, len(answer_ids), MAX_VARIABLES):
+            chunk = answer_ids[start:start + MAX_VARIABLES]
+            placeholders = ", ".join("?" * len(chunk))
+            texts.update(self.conn.execute(f"SELECT AnswerID, AnswerText FROM Answer WHERE AnswerID IN ({placeholders})",
+                                           chunk).fetchall())
+        missing = [answer_id for answer_id in answer_ids if answer_id not in texts]
+        if missing and self.archive is not None:
+            texts.update((answer_id, record["AnswerText"])
+                         for answer_id, record in self.archive.statements(missing).items())
+        return texts
+
+    # Answer columns written to the archive, in zri_archive.FIELDS order
+    ARCHIVE_COLUMNS = '''AnswerID, UserID, QuestionIndex, Question, AnswerText, SubmittedAt, EmotionScore, Obedient,
+                         SelfConsistency, CaseConsistency, ConfidenceScore'''
+
+    def archivable_cases(self, progress, after_case_id, limit):
+        # Next chunk of unarchived CaseIDs with answers whose latest progress is `progress`
+        return [row[0] for row in self.conn.execute(
+            '''SELECT p.CaseID FROM CaseProgress p
+               WHERE p.CaseID > ? AND p.Progress = ?
+                 AND p.ProgressID = (SELECT MAX(ProgressID) FROM CaseProgress WHERE CaseID = p.CaseID)
+                 AND EXISTS (SELECT 1 FROM Answer WHERE CaseID = p.CaseID)
+                 AND NOT EXISTS (SELECT 1 FROM ArchivedCase WHERE CaseID = p.CaseID)
+               ORDER BY p.CaseID LIMIT ?''', (after_case_id, progress, limit))]
+
+    def answers_for_archive(self, case_id):
+        return self.conn.execute(f"SELECT {self.ARCHIVE_COLUMNS} FROM Answer WHERE CaseID = ? ORDER BY AnswerID",
+                                 (case_id,)).fetchall()
+
+    def mark_case_archived(self, case_id, answer_ids):
+        # Drops a case's answers once the archive holds answer_ids. Returns
+        # False, changing nothing, if the case's answers are no longer exactly those.
+        with self.transaction() as cur:
+            current = [row[0] for row in cur.execute("SELECT AnswerID FROM Answer WHERE CaseID = ? ORDER BY AnswerID",
+                                                     (case_id,))]
+            if current != sorted(answer_ids):
+                return False
+            cur.execute("INSERT INTO ArchivedCase (CaseID, AnswerCount) VALUES (?, ?)", (case_id, len(answer_ids)))
+            cur.execute("DELETE FROM Answer WHERE CaseID = ?", (case_id,))
+        metrics.count("db.answers_archived", len(answer_ids))
+        return True
+
+    def is_archived(self, case_id):
+        return self.conn.execute("SELECT 1 FROM ArchivedCase WHERE CaseID = ?", (case_id,)).fetchone() is not None
+
+    def vacuum(self):
+        # Returns the pages freed by archiving to the file system; needs no
+        # other open transaction on this connection
+        if self.conn.in_transaction:
+            raise sqlite3.ProgrammingError("VACUUM cannot run inside a transaction")
+        self.conn.execute("VACUUM")
+
+    def save_case_scores(self, job, case_results, processed, overwrite=False):
+        # Bulk write-back for a batch job. case_results is a list of
+        # (CaseID, [(AnswerID, scores), ...]) in CaseID order. Answer scores
+        # and the job checkpoint are written in one transaction, so an
+        # interrupted run resumes after the last commit; CaseSummary follows
+        # through its triggers.
+        # Returns the number of answers actually written; without overwrite,
+        # answers that already have scores are left alone and not counted.
+        condition = "" if overwrite else "AND ConfidenceScore IS NULL"
+        rows = [(scores['emotion_score'], scores['obedient'], scores['self_consistency'],
+                 scores['case_consistency'], scores['confidence_score'], answer_id)
+                for _, results in case_results for answer_id, scores in results]
+        with self.transaction() as cur:
+            cur.executemany(f'''UPDATE Answer SET EmotionScore = ?, Obedient = ?, SelfConsistency = ?,
+                                                   CaseConsistency = ?, ConfidenceScore = ?
+                                WHERE AnswerID = ? {condition}''', rows)
+            written = cur.rowcount
+            if case_results:
+                cur.execute('''INSERT INTO BatchCheckpoint (JobName, LastCaseID, Processed, UpdatedAt)
+                               VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                               ON CONFLICT (JobName) DO UPDATE SET LastCaseID = excluded.LastCaseID,
+                                   Processed = excluded.Processed, UpdatedAt = excluded.UpdatedAt''',
+                            (job, case_results[-1][0], processed))
+        return written
+
+    def close_connection(self):
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+        self.local = threading.local()
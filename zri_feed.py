@@ -0,0 +1,155 @@
+# In-process publish/subscribe feed of database changes.
+#
+# Triggers append a row to ChangeLog for every change windows care about:
+#
+#   case         a case was added, edited or deleted          (CaseID)
+#   progress     a case's progress was recorded              (CaseID)
+#   participant  someone joined or left a case in some role  (CaseID, UserID)
+#   answer       an answer was submitted or removed          (CaseID, UserID)
+#   score        an answer was scored                        (CaseID, UserID)
+#   role         the Role table changed
+#   progress_state  a progress value was recorded for the first time
+#
+# Writes from any process land in ChangeLog, including the batch scorer and
+# importer. One background thread per process reads it: it checks PRAGMA
+# data_version, which only moves when another connection commits, and reads
+# the new rows only then. Changes are delivered once writes pause for `quiet`
+# seconds, or at least every `max_delay` seconds during a long burst.
+# Duplicates are dropped first, so a bulk import touching one case a thousand
+# times reaches a subscriber as one change.
+#
+# Callbacks run on the feed thread. Writers prune ChangeLog as they append
+# (Database.CHANGE_LOG_RETAIN); a subscriber that misses changes because
+# ChangeLog was pruned past it receives RESET and should reload everything.
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from zri_metrics import metrics
+
+logger = logging.getLogger("zeroreid")
+
+Change = namedtuple("Change", "topic case_id user_id")
+RESET = Change("reset", None, None)
+
+class Subscription:
+    # Receives changes in the given topics that concern one of case_ids or
+    # user_id. case_ids may be a set the subscriber keeps adding to and
+    # removing from; with neither case_ids nor user_id every case matches.
+    def __init__(self, feed, callback, topics=None, case_ids=None, user_id=None):
+        self.feed = feed
+        self.callback = callback
+        self.topics = frozenset(topics) if topics is not None else None
+        self.case_ids = case_ids
+        self.user_id = user_id
+
+    def matches(self, change):
+        if change is RESET:
+            return True
+        if self.topics is not None and change.topic not in self.topics:
+            return False
+        if self.case_ids is None and self.user_id is None:
+            return True
+        return ((self.case_ids is not None and change.case_id in self.case_ids)
+                or (self.user_id is not None and change.user_id == self.user_id))
+
+    def cancel(self):
+        self.feed.unsubscribe(self)
+
+class ChangeFeed:
+    def __init__(self, db, poll_interval=0.25, quiet=0.3, max_delay=2.0):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.quiet = quiet
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.last_seq = None
+        self.data_version = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def subscribe(self, callback, topics=None, case_ids=None, user_id=None):
+        subscription = Subscription(self, callback, topics, case_ids, user_id)
+        with self.lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def start(self):
+        # Only changes committed from now on are delivered
+        self.last_seq = self.db.latest_change_seq()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="change-feed", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    @metrics.timed("feed.poll")
+    def poll(self, chunk=5000):
+        # Changes committed since the last poll, oldest first
+        data_version = self.db.data_version()
+        if data_version == self.data_version:
+            return []
+        self.data_version = data_version
+        changes = []
+        while True:
+            rows = self.db.changes_after(self.last_seq, chunk)
+            if not rows:
+                return changes
+            if rows[0][0] != self.last_seq + 1:
+                # Pruned before this feed read them; sequence numbers have no other gaps
+                logger.warning("Change feed fell behind (%d to %d); subscribers reload", self.last_seq, rows[0][0])
+                changes.append(RESET)
+            changes.extend(Change(topic, case_id, user_id) for _, topic, case_id, user_id in rows)
+            self.last_seq = rows[-1][0]
+            if len(rows) < chunk:
+                return changes
+
+    def deliver(self, changes):
+        changes = list(dict.fromkeys(changes))
+        # Roles and the set of progress states are all the reference data holds
+        if RESET in changes or any(change.topic in ("role", "progress_state") for change in changes):
+            self.db.reference.invalidate()
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            matched = [RESET] if RESET in changes else [change for change in changes if subscription.matches(change)]
+            if not matched:
+                continue
+            try:
+                subscription.callback(matched)
+            except Exception:
+                logger.exception("Change feed subscriber failed")
+            metrics.count("feed.deliveries")
+
+    def run(self):
+        pending = []
+        first_pending = last_change = 0.0
+        try:
+            while not self.stopping.wait(self.poll_interval):
+                try:
+                    changes = self.poll()
+                    now = time.monotonic()
+                    if changes:
+                        metrics.count("feed.changes", len(changes))
+                        if not pending:
+                            first_pending = now
+                        pending.extend(changes)
+                        last_change = now
+                    if pending and (now - last_change >= self.quiet or now - first_pending >= self.max_delay):
+                        batch, pending = pending, []
+                        self.deliver(batch)
+                except Exception:
+                    logger.exception("Change feed poll failed")
+        finally:
+            self.db.close_thread()
@@ -0,0 +1,97 @@
+# Headless bulk import of case files, without going through the admin dialog.
+#
+#   python zri_import.py cases.csv
+#   python zri_import.py cases.json --db witness_submission_system.db --skip-unknown
+#
+# CSV files need a CaseDescription column and may have Witnesses, Suspects
+# and LawEnforcers columns holding comma-separated "First Last" names, the
+# same format the admin dialog accepts. JSON files hold a list of objects
+# with "description" and optional "witnesses", "suspects" and
+# "law_enforcers" lists (or comma-separated strings).
+import argparse
+import csv
+import json
+import logging
+import sys
+import time
+
+from zri_db import Database, UnknownParticipantsError
+
+logger = logging.getLogger("zeroreid")
+
+# Input column / key for each role table
+CSV_COLUMNS = {"Witness": "Witnesses", "Suspect": "Suspects", "LawEnforcer": "LawEnforcers"}
+JSON_KEYS = {"Witness": "witnesses", "Suspect": "suspects", "LawEnforcer": "law_enforcers"}
+
+def split_names(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [name.strip() for name in value if name.strip()]
+
+def read_cases(path):
+    # Yields (description, participants) pairs
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            records = json.load(f)
+        for record in records:
+            participants = {role: split_names(record.get(key)) for role, key in JSON_KEYS.items()}
+            yield record["description"].strip(), participants
+    else:
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                participants = {role: split_names(row.get(column)) for role, column in CSV_COLUMNS.items()}
+                yield row["CaseDescription"].strip(), participants
+
+def import_cases(db, cases, batch_size=1000, skip_unknown=False):
+    # One transaction per batch; returns (imported, skipped)
+    imported = skipped = 0
+    batch = []
+    for case in cases:
+        if not case[0]:
+            skipped += 1
+            continue
+        batch.append(case)
+        if len(batch) >= batch_size:
+            done, missed = import_batch(db, batch, skip_unknown)
+            imported += done
+            skipped += missed
+            batch = []
+    if batch:
+        done, missed = import_batch(db, batch, skip_unknown)
+        imported += done
+        skipped += missed
+    return imported, skipped
+
+def import_batch(db, batch, skip_unknown):
+    case_ids, unknown = db.add_cases(batch, skip_unknown=skip_unknown)
+    for index, names in unknown.items():
+        logger.warning("Skipped case %r: unknown participants %s", batch[index][0], ", ".join(names))
+    return len(case_ids) - len(unknown), len(unknown)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import cases from CSV or JSON files")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--db", default="witness_submission_system.db")
+    parser.add_argument("--batch-size", type=int, default=1000, help="cases written per transaction")
+    parser.add_argument("--skip-unknown", action="store_true",
+                        help="skip cases naming unregistered users instead of aborting the batch")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    db = Database(args.db)
+    start = time.perf_counter()
+    total_imported = total_skipped = 0
+    try:
+        for path in args.files:
+            imported, skipped = import_cases(db, read_cases(path), args.batch_size, args.skip_unknown)
+            logger.info("%s: imported %d cases, skipped %d", path, imported, skipped)
+            total_imported += imported
+            total_skipped += skipped
+    except UnknownParticipantsError as e:
+        logger.error("Import aborted, batch rolled back. %s", e)
+        sys.exit(1)
+    finally:
+        db.close_connection()
+    logger.info("Imported %d cases (%d skipped) in %.2fs", total_imported, total_skipped, time.perf_counter() - start)
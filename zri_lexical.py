@@ -0,0 +1,209 @@
+# Cheap lexical tier in front of the spaCy consistency model.
+#
+# Statements are reduced to MinHash signatures of their lowercased word sets.
+# Two signatures agree in roughly the same fraction of positions as the word
+# sets overlap (Jaccard similarity), which is enough to settle clear-cut
+# pairs: near-duplicates and statements with no words in common. Only the
+# pairs in between need document vectors.
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from zri_metrics import metrics
+
+# Each permutation is a multiply-shift hash, (a * x + b) mod 2^64 keeping the
+# top 31 bits, so every signature slot fits in a uint32
+HASH_SHIFT = np.uint64(33)
+# Signature value of a text without words; never produced by a real shingle
+EMPTY_SLOT = np.uint32(0xFFFFFFFF)
+
+WORD_PATTERN = re.compile(r"\w+")
+
+def shingles(text):
+    return set(WORD_PATTERN.findall(text.lower()))
+
+class MinHasher:
+    def __init__(self, num_perm=128, seed=1):
+        self.num_perm = num_perm
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)  # odd
+        self.b = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64)
+
+    def permute(self, hashes):
+        # Wraps around at 2^64 by design
+        return ((np.outer(hashes, self.a) + self.b) >> HASH_SHIFT).astype(np.uint32)
+
+    def signature(self, text):
+        words = shingles(text)
+        if not words:
+            return np.full(self.num_perm, EMPTY_SLOT, dtype=np.uint32)
+        hashes = np.fromiter((zlib.crc32(word.encode("utf-8")) for word in words), dtype=np.uint64, count=len(words))
+        return self.permute(hashes).min(axis=0)
+
+    def signatures(self, texts):
+        # Hashes the words of all texts in one pass and takes the minimum per text
+        word_sets = [shingles(text) for text in texts]
+        matrix = np.full((len(word_sets), self.num_perm), EMPTY_SLOT, dtype=np.uint32)
+        rows = [row for row, words in enumerate(word_sets) if words]
+        if rows:
+            hashes = np.fromiter((zlib.crc32(word.encode("utf-8")) for row in rows for word in word_sets[row]),
+                                 dtype=np.uint64)
+            starts = np.cumsum([0] + [len(word_sets[row]) for row in rows[:-1]])
+            matrix[rows] = np.minimum.reduceat(self.permute(hashes), starts, axis=0)
+        return matrix
+
+def estimated_jaccard(signatures_a, signatures_b, max_elements=1 << 22):
+    # Matrix of estimated Jaccard similarities between every row of A and B.
+    # Compared block by block over both A and B, so the temporary comparison
+    # array holds at most max_elements slots however many statements there are.
+    result = np.empty((len(signatures_a), len(signatures_b)), dtype=np.float32)
+    slots = signatures_a.shape[1]
+    cols = max(1, min(len(signatures_b), max_elements // slots))
+    rows = max(1, max_elements // (slots * cols))
+    for col in range(0, len(signatures_b), cols):
+        block_b = signatures_b[col:col + cols]
+        for row in range(0, len(signatures_a), rows):
+            block_a = signatures_a[row:row + rows]
+            result[row:row + len(block_a), col:col + len(block_b)] = (
+                block_a[:, None, :] == block_b[None, :, :]).mean(axis=2)
+    return result
+
+class LexicalPrefilter:
+    # Decides consistency for clear-cut pairs from word overlap alone.
+    # Pairs whose estimated Jaccard similarity is at least duplicate_threshold
+    # score duplicate_score, pairs at or below unrelated_threshold score
+    # unrelated_score, and everything in between is left to the full model.
+    # A duplicate scores what the full model gives an identical statement
+    # (1.0). What it gives two statements with no words in common depends on
+    # the model: about 0.5 for unrelated random vectors, but usually 0.6-0.8
+    # for en_core_web_lg. So unrelated_score has no default, and until it is
+    # given or fitted by calibrate() those pairs also go to the full model.
+    def __init__(self, duplicate_threshold=0.9, unrelated_threshold=0.0, duplicate_score=1.0,
+                 unrelated_score=None, num_perm=128, seed=1, cache_size=4096):
+        if not 0.0 <= unrelated_threshold < duplicate_threshold <= 1.0:
+            raise ValueError("Thresholds must satisfy 0 <= unrelated_threshold < duplicate_threshold <= 1")
+        self.duplicate_threshold = duplicate_threshold
+        self.unrelated_threshold = unrelated_threshold
+        self.duplicate_score = duplicate_score
+        self.unrelated_score = unrelated_score
+        self.hasher = MinHasher(num_perm, seed)
+        # Recently seen signatures; the same earlier answers are compared again
+        # with every new answer on a case
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent to scoring workers without the cached signatures
+        state = self.__dict__.copy()
+        del state['cache'], state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def signatures(self, texts):
+        texts = list(texts)
+        matrix = np.empty((len(texts), self.hasher.num_perm), dtype=np.uint32)
+        with self.lock:
+            missing = list(dict.fromkeys(text for text in texts if text not in self.cache))
+            if missing:
+                for text, signature in zip(missing, self.hasher.signatures(missing)):
+                    self.cache[text] = signature
+            for row, text in enumerate(texts):
+                matrix[row] = self.cache[text]
+                self.cache.move_to_end(text)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return matrix
+
+    @classmethod
+    def from_setting(cls, setting):
+        # "on" settles near-duplicates only. "duplicate,unrelated,score" also
+        # settles pairs at or below the unrelated threshold with a score
+        # calibrated against the model in use, e.g. "0.85,0.05,0.71".
+        if not setting or setting.lower() in ("0", "off", "no"):
+            return None
+        if setting.lower() in ("1", "on", "yes"):
+            return cls()
+        values = [float(value) for value in setting.split(",")]
+        if len(values) != 3:
+            raise ValueError(f"Prefilter setting {setting!r} is not \"on\" or \"duplicate,unrelated,score\"")
+        duplicate, unrelated, score = values
+        return cls(duplicate_threshold=duplicate, unrelated_threshold=unrelated, unrelated_score=score)
+
+    @metrics.timed("lexical.decide")
+    def decide(self, texts_a, texts_b):
+        # (scores, ambiguous): scores holds the lexical decision for every pair
+        # and ambiguous marks the pairs that still need the full model
+        signatures_a = self.signatures(texts_a)
+        signatures_b = self.signatures(texts_b)
+        similarity = estimated_jaccard(signatures_a, signatures_b)
+        scores = np.zeros(similarity.shape, dtype=np.float32)
+        duplicate = similarity >= self.duplicate_threshold
+        if self.unrelated_score is not None:
+            unrelated = similarity <= self.unrelated_threshold
+            scores[unrelated] = self.unrelated_score
+        else:
+            unrelated = np.zeros(similarity.shape, dtype=bool)
+        scores[duplicate] = self.duplicate_score
+        ambiguous = ~(duplicate | unrelated)
+        # Statements without words (empty, punctuation only) say nothing
+        # about overlap; leave them to the model
+        ambiguous[(signatures_a == EMPTY_SLOT).all(axis=1), :] = True
+        ambiguous[:, (signatures_b == EMPTY_SLOT).all(axis=1)] = True
+        metrics.count("lexical.decided", int(similarity.size - ambiguous.sum()))
+        metrics.count("lexical.escalated", int(ambiguous.sum()))
+        return scores, ambiguous
+
+    def calibrate(self, pairs, full_scores):
+        # Set the tier scores to the full model's mean over the pairs each tier
+        # decides. full_scores[i] is the full model's consistency for the
+        # (text1, text2) pair pairs[i].
+        pairs = list(pairs)
+        signatures_a = self.signatures(text1 for text1, _ in pairs)
+        signatures_b = self.signatures(text2 for _, text2 in pairs)
+        similarity = (signatures_a == signatures_b).mean(axis=1)
+        full_scores = np.asarray(full_scores, dtype=np.float32)
+        # Pairs decide() always escalates say nothing about either tier
+        has_words = ~(signatures_a == EMPTY_SLOT).all(axis=1) & ~(signatures_b == EMPTY_SLOT).all(axis=1)
+        duplicate = has_words & (similarity >= self.duplicate_threshold)
+        unrelated = has_words & (similarity <= self.unrelated_threshold)
+        if duplicate.any():
+            self.duplicate_score = float(full_scores[duplicate].mean())
+        if unrelated.any():
+            self.unrelated_score = float(full_scores[unrelated].mean())
+
+def compare_with_full_model(analyzer, prefilter, pairs, tolerance=0.05):
+    # Accuracy of the lexical tier against the full model on (text1, text2)
+    # pairs. analyzer should not have a prefilter of its own.
+    pairs = list(pairs)
+    if not pairs:
+        return {"pairs": 0}
+    decided_scores = []
+    full_scores = []
+    escalated = 0
+    for text1, text2 in pairs:
+        scores, ambiguous = prefilter.decide([text1], [text2])
+        if ambiguous[0, 0]:
+            escalated += 1
+            continue
+        decided_scores.append(float(scores[0, 0]))
+        full_scores.append(analyzer.calculate_consistency_score(text1, text2))
+
+    report = {"pairs": len(pairs), "escalated": escalated, "escalated_fraction": escalated / len(pairs),
+              "decided": len(decided_scores)}
+    if decided_scores:
+        errors = np.abs(np.array(decided_scores) - np.array(full_scores))
+        report.update({
+            "mean_abs_error": float(errors.mean()),
+            "max_abs_error": float(errors.max()),
+            f"within_{tolerance}": float((errors <= tolerance).mean()),
+        })
+    return report
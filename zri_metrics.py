@@ -0,0 +1,270 @@
+# Lightweight timing spans and counters for the analysis and database layers.
+#
+# Everything records into the process-wide `metrics` registry. Latency
+# percentiles come from a bounded reservoir of recent samples per span, so
+# memory stays flat however long the app runs. Snapshots can be exported as
+# Prometheus text or JSON, and ProfileCapture adds optional cProfile and
+# tracemalloc captures on top.
+import cProfile
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+# Recent samples kept per span for percentiles
+RESERVOIR_SIZE = 2048
+
+def normalize_sql(sql):
+    sql = " ".join(sql.split())
+    return sql if len(sql) <= 200 else sql[:197] + "..."
+
+class SpanStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.rows = 0
+        self.samples = deque(maxlen=RESERVOIR_SIZE)
+
+    def add(self, seconds, error=False):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.errors += int(error)
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}  # (kind, name) -> SpanStats; kind is "span" or "query"
+        self.counters = {}
+
+    def record(self, kind, name, seconds, error=False):
+        with self.lock:
+            stats = self.spans.get((kind, name))
+            if stats is None:
+                stats = self.spans[(kind, name)] = SpanStats()
+            stats.add(seconds, error)
+
+    def add_rows(self, sql, rows):
+        with self.lock:
+            stats = self.spans.get(("query", sql))
+            if stats is not None:
+                stats.rows += rows
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def span(self, name, kind="span"):
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record(kind, name, time.perf_counter() - start, error)
+
+    def timed(self, name):
+        # Decorator form of span(), without the context-manager overhead
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                error = True
+                try:
+                    result = function(*args, **kwargs)
+                    error = False
+                    return result
+                finally:
+                    self.record("span", name, time.perf_counter() - start, error)
+            return wrapper
+        return decorate
+
+    def ratio(self, hits, misses):
+        with self.lock:
+            hit = sum(self.counters.get(name, 0) for name in hits)
+            miss = sum(self.counters.get(name, 0) for name in misses)
+        return hit / (hit + miss) if hit + miss else None
+
+    def snapshot(self):
+        with self.lock:
+            spans = [{
+                "kind": kind,
+                "name": name,
+                "count": stats.count,
+                "errors": stats.errors,
+                "rows": stats.rows,
+                "total_s": stats.total,
+                "p50_ms": stats.percentile(0.50) * 1000,
+                "p99_ms": stats.percentile(0.99) * 1000,
+                "max_ms": stats.max * 1000,
+            } for (kind, name), stats in self.spans.items()]
+            counters = dict(self.counters)
+        spans.sort(key=lambda span: -span["total_s"])
+        return {"timestamp": time.time(), "pid": os.getpid(), "spans": spans, "counters": counters,
+                "statement_cache_hit_rate": self.ratio(("cache.hot_hits", "cache.db_hits"), ("cache.misses",))}
+
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+            self.counters.clear()
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+
+        def label(value):
+            return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+        lines = []
+        for metric, kind, key in (("zeroreid_span_seconds", "span", "name"), ("zeroreid_query_seconds", "query", "query")):
+            lines.append(f"# TYPE {metric} summary")
+            for span in snapshot["spans"]:
+                if span["kind"] != kind:
+                    continue
+                labels = f'{key}="{label(span["name"])}"'
+                lines.append(f'{metric}{{{labels},quantile="0.5"}} {span["p50_ms"] / 1000:.6f}')
+                lines.append(f'{metric}{{{labels},quantile="0.99"}} {span["p99_ms"] / 1000:.6f}')
+                lines.append(f"{metric}_sum{{{labels}}} {span['total_s']:.6f}")
+                lines.append(f"{metric}_count{{{labels}}} {span['count']}")
+        lines.append("# TYPE zeroreid_query_rows_total counter")
+        for span in snapshot["spans"]:
+            if span["kind"] == "query":
+                lines.append(f'zeroreid_query_rows_total{{query="{label(span["name"])}"}} {span["rows"]}')
+        lines.append("# TYPE zeroreid_events_total counter")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f'zeroreid_events_total{{name="{label(name)}"}} {value}')
+        if snapshot["statement_cache_hit_rate"] is not None:
+            lines.append("# TYPE zeroreid_statement_cache_hit_ratio gauge")
+            lines.append(f"zeroreid_statement_cache_hit_ratio {snapshot['statement_cache_hit_rate']:.6f}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # Written to a temporary file and renamed so a scraper never reads half a file
+        temporary = path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(temporary, path)
+
+    def write_json(self, path):
+        # Appends one snapshot per line
+        with open(path, "a") as f:
+            f.write(json.dumps(self.snapshot()) + "\n")
+
+    def export(self, path):
+        if path.endswith(".json") or path.endswith(".jsonl"):
+            self.write_json(path)
+        else:
+            self.write_prometheus(path)
+
+metrics = Metrics()
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Times every statement and counts the rows it returns or changes
+    query = None
+
+    def execute(self, sql, parameters=()):
+        return self.timed_call(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.timed_call(super().executemany, sql, seq_of_parameters)
+
+    def timed_call(self, method, sql, parameters):
+        self.query = normalize_sql(sql)
+        start = time.perf_counter()
+        error = True
+        try:
+            result = method(sql, parameters)
+            error = False
+            return result
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e) or "busy" in str(e):
+                metrics.count("db.lock_timeouts")
+            raise
+        finally:
+            metrics.record("query", self.query, time.perf_counter() - start, error)
+            if self.rowcount > 0:
+                metrics.add_rows(self.query, self.rowcount)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            metrics.add_rows(self.query, 1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        metrics.add_rows(self.query, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        metrics.add_rows(self.query, len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        metrics.add_rows(self.query, 1)
+        return row
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Routes Connection.execute shortcuts through InstrumentedCursor too
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class ProfileCapture:
+    # Optional deep capture: cProfile for CPU time and tracemalloc for
+    # allocations, written to output_dir when stopped
+    def __init__(self, output_dir="."):
+        self.output_dir = output_dir
+        self.profiler = None
+
+    @property
+    def running(self):
+        return self.profiler is not None
+
+    def start(self):
+        if self.running:
+            return
+        tracemalloc.start(25)
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop(self):
+        # Returns the paths written
+        if not self.running:
+            return []
+        self.profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        os.makedirs(self.output_dir, exist_ok=True)
+        profile_path = os.path.join(self.output_dir, f"zeroreid-{stamp}.prof")
+        memory_path = os.path.join(self.output_dir, f"zeroreid-{stamp}-memory.txt")
+        self.profiler.dump_stats(profile_path)
+        with open(memory_path, "w") as f:
+            for stat in snapshot.statistics("lineno")[:50]:
+                f.write(f"{stat}\n")
+        self.profiler = None
+        return [profile_path, memory_path]
@@ -0,0 +1,197 @@
+# Loading the spaCy pipeline in one of three modes.
+#
+#   full     en_core_web_lg exactly as packaged
+#   slim     the same vectors and tokenizer, without tagger, parser, NER and
+#            the other trained components. Document vectors are averages of
+#            static word vectors, so consistency scores are unchanged.
+#   compact  the model's tokenizer plus a pruned vector table exported by
+#            build_compact_table(). The table is memory-mapped, so every
+#            scoring worker on a host shares one copy through the page cache.
+#
+#   python zri_nlp.py build compact_vectors --max-vectors 50000
+#   python zri_nlp.py compare --table compact_vectors
+#
+# The mode comes from ZRI_NLP_MODE ("full", "slim" or "compact:<directory>"),
+# which scoring worker processes inherit; the default is slim.
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+try:
+    import spacy
+except ImportError:
+    spacy = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MODEL_NAME = "en_core_web_lg"
+# Trained components that do not contribute to Doc.vector
+UNUSED_COMPONENTS = ("tok2vec", "tagger", "morphologizer", "parser", "senter", "attribute_ruler", "lemmatizer", "ner")
+
+def load_pipeline(mode=None, model=MODEL_NAME):
+    mode = mode or os.environ.get("ZRI_NLP_MODE", "slim")
+    if spacy is None:
+        raise ImportError("spaCy is required to load a language model")
+    if mode == "full":
+        return spacy.load(model)
+    if mode == "slim":
+        return spacy.load(model, exclude=list(UNUSED_COMPONENTS))
+    if mode.startswith("compact:"):
+        return CompactPipeline(mode[len("compact:"):])
+    raise ValueError(f"Unknown NLP mode: {mode!r} (expected full, slim or compact:<directory>)")
+
+def build_compact_table(directory, max_vectors, model=MODEL_NAME):
+    # Keeps the max_vectors most frequent rows of the model's vector table.
+    # Every other word is mapped to its nearest kept row, so rarer words keep
+    # an approximate vector instead of dropping out of the average.
+    nlp = spacy.load(model, exclude=list(UNUSED_COMPONENTS))
+    nlp.vocab.prune_vectors(max_vectors)
+    vectors = nlp.vocab.vectors
+    keys = np.fromiter(vectors.key2row.keys(), dtype=np.uint64, count=len(vectors.key2row))
+    rows = np.fromiter(vectors.key2row.values(), dtype=np.int32, count=len(vectors.key2row))
+    order = np.argsort(keys)
+
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, "vectors.npy"), np.ascontiguousarray(vectors.data, dtype=np.float32))
+    np.save(os.path.join(directory, "keys.npy"), keys[order])
+    np.save(os.path.join(directory, "rows.npy"), rows[order])
+    nlp.tokenizer.to_disk(os.path.join(directory, "tokenizer"))
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump({"name": f"{nlp.meta['name']}-compact{max_vectors}", "version": nlp.meta["version"],
+                   "lang": nlp.lang, "vectors": int(vectors.data.shape[0]), "keys": len(keys)}, f)
+
+class CompactDoc(list):
+    # The parts of spacy.tokens.Doc that SentimentAnalysis reads: the tokens
+    # and the document vector
+    def __init__(self, tokens, vector):
+        super().__init__(tokens)
+        self.vector = vector
+
+class CompactVocab:
+    def __init__(self, width):
+        self.vectors_length = width
+
+class CompactPipeline:
+    # Tokenizer plus memory-mapped vector table. Doc vectors follow spaCy:
+    # the mean over all tokens, with zeros for tokens that have no vector.
+    pipe_names = ()
+
+    def __init__(self, directory):
+        if spacy is None:
+            raise ImportError("spaCy is required for the compact pipeline's tokenizer")
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        self.keys = np.load(os.path.join(directory, "keys.npy"), mmap_mode="r")
+        self.rows = np.load(os.path.join(directory, "rows.npy"), mmap_mode="r")
+        self.vocab = CompactVocab(self.vectors.shape[1])
+        blank = spacy.blank(self.meta["lang"])
+        self.tokenizer = blank.tokenizer.from_disk(os.path.join(directory, "tokenizer"))
+
+    def document(self, doc):
+        tokens = list(doc)
+        if not tokens:
+            return CompactDoc(tokens, np.zeros(self.vocab.vectors_length, dtype=np.float32))
+        orths = np.fromiter((token.orth for token in tokens), dtype=np.uint64, count=len(tokens))
+        positions = np.minimum(np.searchsorted(self.keys, orths), len(self.keys) - 1)
+        found = self.keys[positions] == orths
+        vector = self.vectors[self.rows[positions[found]]].sum(axis=0, dtype=np.float32) / len(tokens)
+        return CompactDoc(tokens, np.asarray(vector, dtype=np.float32))
+
+    def __call__(self, text):
+        return self.document(self.tokenizer(text))
+
+    def pipe(self, texts, disable=()):
+        for doc in self.tokenizer.pipe(texts):
+            yield self.document(doc)
+
+def private_memory_kb():
+    # Memory this process does not share with others (Linux); the shared,
+    # memory-mapped vector table is not counted
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = dict(re.findall(r"^(\w+):\s+(\d+) kB", f.read(), re.M))
+        return int(fields["Private_Clean"]) + int(fields["Private_Dirty"])
+    except (OSError, KeyError):
+        return None
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def _measure_mode(mode, texts):
+    # Runs in a fresh process so each mode starts from the same baseline
+    baseline_private = private_memory_kb()
+    start = time.perf_counter()
+    nlp = load_pipeline(mode)
+    load_seconds = time.perf_counter() - start
+    private = private_memory_kb()
+    vectors = np.asarray([doc.vector for doc in nlp.pipe(texts)], dtype=np.float32)
+    return {
+        "mode": mode,
+        "load_s": load_seconds,
+        "peak_rss_kb": peak_rss_kb(),
+        "private_kb": private - baseline_private if private is not None and baseline_private is not None else None,
+    }, vectors
+
+def compare_modes(modes, texts):
+    # Load time, memory and consistency agreement with the first mode
+    context = multiprocessing.get_context("spawn")
+    reports = []
+    reference = None
+    for mode in modes:
+        with context.Pool(1) as pool:
+            report, vectors = pool.apply(_measure_mode, (mode, texts))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        unit = np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+        scores = (np.clip(unit @ unit.T, -1.0, 1.0) + 1) / 2
+        if reference is None:
+            reference = scores
+        report["consistency_mean_abs_diff"] = float(np.abs(scores - reference).mean())
+        report["consistency_max_abs_diff"] = float(np.abs(scores - reference).max())
+        reports.append(report)
+    return reports
+
+SAMPLE_STATEMENTS = (
+    "I saw a tall man running out of the store with a bag.",
+    "He ran out of the shop carrying something, maybe a backpack.",
+    "I was at home all night watching television with my sister.",
+    "The car was red and drove away quickly towards the highway.",
+    "It was a blue van, and it stayed parked near the corner for an hour.",
+    "I heard shouting and then a window breaking around midnight.",
+    "Nobody came in or out after ten o'clock, I am sure of it.",
+    "She looked afraid and kept asking us to call the police.",
+)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build compact vector tables and compare NLP modes")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="export a pruned, memory-mappable vector table")
+    build.add_argument("directory")
+    build.add_argument("--max-vectors", type=int, default=50000, help="distinct vectors kept")
+    compare = commands.add_parser("compare", help="report load time and memory per mode")
+    compare.add_argument("--table", help="compact table directory to include")
+    compare.add_argument("--statements", help="text file with one statement per line to compare scores on")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_compact_table(args.directory, args.max_vectors)
+    else:
+        texts = list(SAMPLE_STATEMENTS)
+        if args.statements:
+            with open(args.statements, encoding="utf-8") as f:
+                texts = [line.strip() for line in f if line.strip()]
+        modes = ["full", "slim"] + ([f"compact:{args.table}"] if args.table else [])
+        for report in compare_modes(modes, texts):
+            print(json.dumps(report))
@@ -0,0 +1,327 @@
+# Persistent nearest-neighbour index over statement document vectors.
+#
+#   python zri_vector_index.py sync                    # index answers added since the last sync
+#   python zri_vector_index.py query "ran to the car" --role Suspect -k 5
+#
+# Unit-length vectors live in a memory-mapped float32 file next to a
+# memory-mapped row table (AnswerID, CaseID, role, inverted list), so opening
+# the index costs nothing per statement and the OS pages in only what a query
+# touches. Until the index holds enough statements to train on it is searched
+# exhaustively; after that it becomes an IVF index: k-means centroids split
+# the statements into inverted lists and a query only scores the nprobe lists
+# nearest to it. Queries limited to specific cases go straight to those
+# cases' rows instead. Scores are consistency scores, (cosine + 1) / 2, the
+# same scale calculate_consistency_score uses.
+import argparse
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from zri_db import ROLE_TABLES
+from zri_metrics import metrics
+
+logger = logging.getLogger("zeroreid")
+
+# Role column codes; 0 means the author is not on the case's role tables
+ROLE_CODES = {role: code for code, role in enumerate(ROLE_TABLES, start=1)}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+ROW_DTYPE = np.dtype([('answer_id', '<i8'), ('case_id', '<i8'), ('role', 'i1'), ('list', '<i4')])
+
+class StatementIndex:
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, directory, nlist=64, nprobe=8):
+        self.directory = directory
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.lock = threading.RLock()
+        self.vectors = None
+        self.rows = None
+        self.centroids = None
+        os.makedirs(directory, exist_ok=True)
+        self.meta = {"dim": None, "count": 0, "capacity": 0, "last_answer_id": 0, "model_version": None}
+        if os.path.exists(self.path("meta.json")):
+            with open(self.path("meta.json")) as f:
+                self.meta.update(json.load(f))
+            self.open_files()
+            if os.path.exists(self.path("centroids.npy")):
+                self.centroids = np.load(self.path("centroids.npy"))
+        self.rebuild_lookups()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def __len__(self):
+        return self.meta["count"]
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    @property
+    def last_answer_id(self):
+        return self.meta["last_answer_id"]
+
+    def open_files(self):
+        capacity, dim = self.meta["capacity"], self.meta["dim"]
+        self.vectors = np.memmap(self.path("vectors.f32"), dtype=np.float32, mode="r+", shape=(capacity, dim))
+        self.rows = np.memmap(self.path("rows.dat"), dtype=ROW_DTYPE, mode="r+", shape=(capacity,))
+
+    def resize_files(self, capacity):
+        # Files only ever grow; rows past "count" are unused
+        self.flush()
+        self.vectors = self.rows = None
+        for name, row_bytes in (("vectors.f32", 4 * self.meta["dim"]), ("rows.dat", ROW_DTYPE.itemsize)):
+            with open(self.path(name), "ab") as f:
+                f.truncate(capacity * row_bytes)
+        self.meta["capacity"] = capacity
+        self.open_files()
+
+    def save_meta(self):
+        # Written last and replaced atomically: a crash mid-insert leaves the
+        # previous count, so half-written rows are never read
+        temporary = self.path("meta.json.tmp")
+        with open(temporary, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(temporary, self.path("meta.json"))
+
+    def flush(self):
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.rows.flush()
+
+    def rebuild_lookups(self):
+        # In-memory row lists per case and per inverted list, from the row table
+        self.answer_ids = set()
+        self.case_rows = {}
+        self.list_rows = {}
+        count = self.meta["count"]
+        if not count:
+            return
+        rows = np.asarray(self.rows[:count])
+        self.answer_ids = set(rows['answer_id'].tolist())
+        self.case_rows = self.group_rows(rows['case_id'])
+        if self.trained:
+            self.list_rows = self.group_rows(rows['list'])
+
+    @staticmethod
+    def group_rows(keys):
+        order = np.argsort(keys, kind="stable")
+        values, starts = np.unique(keys[order], return_index=True)
+        return {int(value): [chunk] for value, chunk in zip(values, np.split(order, starts[1:]))}
+
+    @staticmethod
+    def lookup(groups, key):
+        # Row numbers for one group; appended chunks are merged on first read
+        chunks = groups.get(key)
+        if not chunks:
+            return np.zeros(0, dtype=np.int64)
+        if len(chunks) > 1:
+            chunks[:] = [np.concatenate(chunks)]
+        return chunks[0]
+
+    @staticmethod
+    def unit(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    def reset(self, model_version=None):
+        # Forget every statement, e.g. after the language model changed
+        with self.lock:
+            self.vectors = self.rows = self.centroids = None
+            for name in ("vectors.f32", "rows.dat", "centroids.npy", "meta.json"):
+                if os.path.exists(self.path(name)):
+                    os.remove(self.path(name))
+            self.meta = {"dim": None, "count": 0, "capacity": 0, "last_answer_id": 0, "model_version": model_version}
+            self.rebuild_lookups()
+
+    @metrics.timed("index.add")
+    def add(self, answer_ids, case_ids, roles, vectors):
+        # Appends statements; roles are role table names (or None). AnswerIDs
+        # already in the index are skipped. Returns the number added.
+        with self.lock:
+            vectors = self.unit(vectors)
+            keep = [i for i, answer_id in enumerate(answer_ids) if answer_id not in self.answer_ids]
+            if not keep:
+                return 0
+            if self.meta["dim"] is None:
+                self.meta["dim"] = vectors.shape[1]
+                self.resize_files(self.INITIAL_CAPACITY)
+            elif vectors.shape[1] != self.meta["dim"]:
+                raise ValueError(f"Expected {self.meta['dim']}-dimensional vectors, got {vectors.shape[1]}")
+
+            start = self.meta["count"]
+            end = start + len(keep)
+            if end > self.meta["capacity"]:
+                capacity = self.meta["capacity"]
+                while capacity < end:
+                    capacity *= 2
+                self.resize_files(capacity)
+
+            new_rows = np.zeros(len(keep), dtype=ROW_DTYPE)
+            new_rows['answer_id'] = [answer_ids[i] for i in keep]
+            new_rows['case_id'] = [case_ids[i] for i in keep]
+            new_rows['role'] = [ROLE_CODES.get(roles[i], 0) for i in keep]
+            new_vectors = vectors[keep]
+            new_rows['list'] = self.assign(new_vectors) if self.trained else -1
+            self.vectors[start:end] = new_vectors
+            self.rows[start:end] = new_rows
+            self.flush()
+            self.meta["count"] = end
+            self.meta["last_answer_id"] = max(self.meta["last_answer_id"], int(new_rows['answer_id'].max()))
+            self.save_meta()
+
+            positions = np.arange(start, end)
+            self.answer_ids.update(new_rows['answer_id'].tolist())
+            for key, chunk in self.group_rows(new_rows['case_id']).items():
+                self.case_rows.setdefault(key, []).append(positions[chunk[0]])
+            if self.trained:
+                for key, chunk in self.group_rows(new_rows['list']).items():
+                    self.list_rows.setdefault(key, []).append(positions[chunk[0]])
+            elif end >= self.nlist * 40:
+                # Enough statements for stable centroids (about 40 per list)
+                self.train()
+            return len(keep)
+
+    def assign(self, unit_vectors):
+        return np.argmax(unit_vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    @metrics.timed("index.train")
+    def train(self, iterations=10, sample_size=None, seed=0):
+        # Spherical k-means on a sample, then every row is assigned to its
+        # nearest centroid. Can be rerun to rebalance after heavy growth.
+        with self.lock:
+            count = self.meta["count"]
+            nlist = min(self.nlist, count)
+            if nlist == 0:
+                return
+            rng = np.random.default_rng(seed)
+            sample_size = min(count, sample_size or nlist * 256)
+            sample = np.asarray(self.vectors[np.sort(rng.choice(count, sample_size, replace=False))])
+            centroids = sample[rng.choice(sample_size, nlist, replace=False)]
+            for _ in range(iterations):
+                labels = np.argmax(sample @ centroids.T, axis=1)
+                for cluster in range(nlist):
+                    members = sample[labels == cluster]
+                    if len(members):
+                        centroids[cluster] = members.sum(axis=0)
+                centroids = self.unit(centroids)
+            self.centroids = centroids
+
+            for start in range(0, count, 65536):
+                end = min(start + 65536, count)
+                self.rows['list'][start:end] = self.assign(np.asarray(self.vectors[start:end]))
+            self.flush()
+            temporary = self.path("centroids.tmp.npy")
+            np.save(temporary, centroids)
+            os.replace(temporary, self.path("centroids.npy"))
+            self.list_rows = self.group_rows(np.asarray(self.rows['list'][:count]))
+            logger.info("Trained statement index: %d statements in %d lists", count, nlist)
+
+    @metrics.timed("index.query")
+    def query(self, vector, k=10, case_ids=None, roles=None, nprobe=None, exclude_answer_ids=()):
+        # Top-k statements nearest to vector as (AnswerID, CaseID, role, score),
+        # best first. case_ids and roles restrict the candidates.
+        with self.lock:
+            count = self.meta["count"]
+            query = self.unit(np.asarray(vector, dtype=np.float32).reshape(1, -1))[0]
+            if not count or not query.any():
+                return []
+            if case_ids is not None:
+                candidates = np.concatenate([self.lookup(self.case_rows, int(case_id)) for case_id in case_ids] or
+                                            [np.zeros(0, dtype=np.int64)])
+            elif self.trained:
+                nearest = np.argsort(-(self.centroids @ query))[:nprobe or self.nprobe]
+                candidates = np.concatenate([self.lookup(self.list_rows, int(cluster)) for cluster in nearest])
+            else:
+                candidates = np.arange(count)
+            candidates = np.sort(candidates)  # sequential reads from the memory map
+
+            if roles is not None or exclude_answer_ids:
+                rows = self.rows[candidates]
+                keep = np.ones(len(candidates), dtype=bool)
+                if roles is not None:
+                    keep &= np.isin(rows['role'], [ROLE_CODES[role] for role in roles])
+                if exclude_answer_ids:
+                    keep &= ~np.isin(rows['answer_id'], list(exclude_answer_ids))
+                candidates = candidates[keep]
+            if not len(candidates):
+                return []
+
+            similarity = np.empty(len(candidates), dtype=np.float32)
+            for start in range(0, len(candidates), 65536):
+                chunk = candidates[start:start + 65536]
+                similarity[start:start + len(chunk)] = self.vectors[chunk] @ query
+            top = min(k, len(candidates))
+            best = np.argpartition(-similarity, top - 1)[:top]
+            best = best[np.argsort(-similarity[best], kind="stable")]
+            rows = self.rows[candidates[best]]
+            return [(int(row['answer_id']), int(row['case_id']), ROLE_NAMES.get(int(row['role'])),
+                     float((np.clip(score, -1.0, 1.0) + 1) / 2))
+                    for row, score in zip(rows, similarity[best])]
+
+    def search(self, analyzer, text, k=10, case_ids=None, roles=None, nprobe=None, exclude_answer_ids=()):
+        vectors, _ = analyzer.document_vectors([text])
+        return self.query(vectors[0], k, case_ids, roles, nprobe, exclude_answer_ids)
+
+    def sync(self, db, analyzer, chunk=256):
+        # Index every answer stored since the last sync; returns how many were added
+        model_version = analyzer.model_version()
+        if self.meta["model_version"] != model_version:
+            if self.meta["count"]:
+                logger.warning("Statement index was built with %s; rebuilding for %s",
+                               self.meta["model_version"], model_version)
+            self.reset(model_version)
+            self.save_meta()
+        added = 0
+        while True:
+            answers = db.indexable_answers(self.last_answer_id, chunk)
+            if not answers:
+                return added
+            vectors, _ = analyzer.document_vectors([text for _, _, _, text in answers])
+            added += self.add([row[0] for row in answers], [row[1] for row in answers],
+                              [row[2] for row in answers], vectors)
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.vectors = self.rows = None
+
+if __name__ == "__main__":
+    from zri_db import Database
+    from zri_analysis import SentimentAnalysis, ensure_vader_lexicon
+
+    parser = argparse.ArgumentParser(description="Maintain and query the statement similarity index")
+    parser.add_argument("command", choices=("sync", "train", "query"))
+    parser.add_argument("text", nargs="?", help="statement to search for (query)")
+    parser.add_argument("--db", default="witness_submission_system.db")
+    parser.add_argument("--index", default="statement_index", help="index directory")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--case", type=int, action="append", help="restrict to this CaseID (repeatable)")
+    parser.add_argument("--role", choices=ROLE_TABLES, action="append", help="restrict to this role (repeatable)")
+    parser.add_argument("--nprobe", type=int, default=None, help="inverted lists searched per query")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    db = Database(args.db)
+    index = StatementIndex(args.index)
+    try:
+        if args.command == "train":
+            index.train()
+        else:
+            ensure_vader_lexicon()
+            analyzer = SentimentAnalysis(cache_file=args.db)
+            added = index.sync(db, analyzer)
+            logger.info("Indexed %d new statements (%d total)", added, len(index))
+            if args.command == "query":
+                for answer_id, case_id, role, score in index.search(analyzer, args.text or "", args.k, args.case,
+                                                                    args.role, args.nprobe):
+                    print(f"{score:.3f}  case {case_id}  {role or '-':<12} answer {answer_id}")
+    finally:
+        index.close()
+        db.close_connection()